@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Benchmarks of the page pipeline's hot paths (loading, transforming, writing
+and extracting images), run on synthetic documents generated offline. Each
+stage is timed separately, and the results can be saved as JSON and
+compared against a stored baseline. Like the command line interface, this
+module must not import Qt.
+
+Examples:
+    benchmark.py --pages 1 1000 --images flate dct --output results.json
+    benchmark.py --pages 50000 --unshared-fonts --stages load write
+    benchmark.py --baseline baseline.json --threshold 0.2
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import os
+import os.path as osp
+import sys
+import gc
+import json
+import time
+import shutil
+import zlib
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import multiprocessing
+from io import BytesIO
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from PIL import Image
+import PyPDF2 as pdf
+
+import pdf_images
+import pdf_pages
+import pdf_sources
+
+
+image_kinds = ['flate', 'dct', 'ccitt', 'indexed']
+stages = ['load', 'load_images', 'transform', 'write', 'extract']
+
+_font = "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+
+
+def synthetic_image(kind, size=256):
+    """Returns the dictionary entries and the data of an Image XObject of
+    `size`x`size` pixels, compressed as `kind` (see `image_kinds`).
+    """
+    img = Image.linear_gradient('L').resize((size, size))
+    if kind == 'flate':
+        img = Image.merge('RGB', (img, img.transpose(Image.ROTATE_90),
+                                  img.transpose(Image.ROTATE_180)))
+        return ("/Filter /FlateDecode /BitsPerComponent 8 "
+                "/ColorSpace /DeviceRGB", zlib.compress(img.tobytes()))
+    elif kind == 'dct':
+        buf = BytesIO()
+        img.convert('RGB').save(buf, 'JPEG', quality=85)
+        return ("/Filter /DCTDecode /BitsPerComponent 8 "
+                "/ColorSpace /DeviceRGB", buf.getvalue())
+    elif kind == 'ccitt':
+        buf = BytesIO()
+        img.convert('1').save(buf, 'TIFF', compression='group4')
+        buf.seek(0)
+        with Image.open(buf) as tiff:
+            return pdf_images._ccitt_strip(tiff)
+    elif kind == 'indexed':
+        img = img.quantize(64)
+        palette = img.getpalette()[:64 * 3]
+        return ("/Filter /FlateDecode /BitsPerComponent 8 "
+                "/ColorSpace [/Indexed /DeviceRGB 63 <{}>]".format(
+                    bytes(palette).hex()), zlib.compress(img.tobytes()))
+    raise ValueError("unknown image kind {}".format(kind))
+
+
+def synthetic_pdf(filename, pages, shared_fonts=True, images=(),
+                  image_size=256):
+    """Writes a PDF with `pages` pages of text, each showing one image of
+    every kind in `images`. With `shared_fonts`, all pages use the same
+    font object; otherwise each page has its own copy, as in documents
+    joined from many single page files. Every page has its own image
+    objects, with the same data. Returns the size of the file.
+    """
+    image_data = [synthetic_image(kind, image_size) for kind in images]
+    offsets = [None, None, None]  # Catalog, page tree, shared font
+
+    with open(filename, 'wb') as f:
+        def write(idnum, *parts):
+            offsets[idnum - 1] = f.tell()
+            f.write("{} 0 obj\n".format(idnum).encode('ascii'))
+            for part in parts:
+                if not isinstance(part, bytes):
+                    part = part.encode('ascii')
+                f.write(part)
+            f.write(b"\nendobj\n")
+
+        def allocate():
+            offsets.append(None)
+            return len(offsets)
+
+        f.write(b"%PDF-1.5\n%\xE2\xE3\xCF\xD3\n")
+        write(1, "<< /Type /Catalog /Pages 2 0 R >>")
+        if shared_fonts:
+            write(3, _font)
+        kids = []
+        for page_number in range(pages):
+            page_id = allocate()
+            kids.append(page_id)
+            content = ["BT /F1 24 Tf 72 720 Td (Page {}) Tj ET".format(
+                page_number + 1)]
+            xobjects = []
+            for i, (image, data) in enumerate(image_data):
+                image_id = allocate()
+                write(image_id, "<< /Type /XObject /Subtype /Image /Width "
+                      "{0} /Height {0} {1} /Length {2} >>\nstream\n".format(
+                          image_size, image, len(data)),
+                      data, "\nendstream")
+                xobjects.append("/Im{} {} 0 R".format(i, image_id))
+                content.append("q 144 0 0 144 {} {} cm /Im{} Do Q".format(
+                    72 + 160 * (i % 3), 480 - 160 * (i // 3), i))
+            font_id = 3
+            if not shared_fonts:
+                font_id = allocate()
+                write(font_id, _font)
+            content = "\n".join(content)
+            content_id = allocate()
+            write(content_id, "<< /Length {} >>\nstream\n{}\nendstream"
+                  .format(len(content), content))
+            write(page_id, "<< /Type /Page /Parent 2 0 R /MediaBox "
+                  "[0 0 612 792] /Resources << /Font << /F1 {} 0 R >> "
+                  "/XObject << {} >> >> /Contents {} 0 R >>".format(
+                      font_id, " ".join(xobjects), content_id))
+        write(2, "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join("{} 0 R".format(kid) for kid in kids), pages))
+
+        xref = f.tell()
+        f.write("xref\n0 {}\n0000000000 65535 f \n".format(
+            len(offsets) + 1).encode('ascii'))
+        for offset in offsets:
+            if offset is None:
+                f.write(b"0000000000 00000 f \n")
+            else:
+                f.write("{:010} 00000 n \n".format(offset).encode('ascii'))
+        f.write("trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n"
+                .format(len(offsets) + 1, xref).encode('ascii'))
+        return f.tell()
+
+
+def synthetic_image_files(dirname, count, size=256):
+    """Writes `count` image files, alternating between JPEG and PNG, and
+    returns their names.
+    """
+    img = Image.linear_gradient('L').resize((size, size)).convert('RGB')
+    filenames = []
+    for i in range(count):
+        filename = osp.join(dirname, "img{:05}.{}".format(
+            i, 'jpg' if i % 2 == 0 else 'png'))
+        img.save(filename)
+        filenames.append(filename)
+    return filenames
+
+
+def peak_rss():
+    """Peak resident set size of this process and its finished children,
+    in bytes, or None where it can't be measured. It's the peak since the
+    process started, so it's only reported for the whole run.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes, except on macOS, where it's in bytes
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return unit * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _output_bytes(filenames):
+    return sum(osp.getsize(filename) for filename in filenames
+               if osp.exists(filename))
+
+
+def measure(function, repeat=1, trace=False):
+    """Runs `function` `repeat` times, keeping the fastest run. `function`
+    returns the files it wrote, which are counted as output bytes.
+
+    With `trace`, the peak of the memory allocated by Python while the
+    runs were going (see tracemalloc), not counting what earlier stages
+    left allocated nor worker processes, is recorded as `peak_traced`.
+    Tracing slows the runs down, so it's off by default.
+    """
+    best = None
+    peak = None
+    if trace:
+        tracemalloc.start()
+    try:
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            filenames = function()
+            wall = time.perf_counter() - start
+            best = wall if best is None else min(best, wall)
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if trace:
+            tracemalloc.stop()
+    return {'wall': best, 'peak_traced': peak,
+            'output_bytes': _output_bytes(filenames)}
+
+
+def run_case(dirname, pages, shared_fonts, images, image_size, stages,
+             repeat=1, processes=None, trace=False):
+    """Generates a document and times the pipeline stages on it, in order.
+    Returns {stage: {'wall': seconds, 'peak_traced': bytes or None,
+    'output_bytes': bytes}} (see `measure`), plus the input size and the
+    stages run. Pages are written and extracted as the earlier stages left
+    them (e.g. stamped).
+    """
+    filename = osp.join(dirname, 'input.pdf')
+    results = {'input_bytes': synthetic_pdf(filename, pages, shared_fonts,
+                                            images, image_size),
+               'stages': list(stages)}
+    loaded = []
+
+    def load():
+        # Drop the pages of earlier runs, so the document is parsed again
+        loaded[:] = []
+        pdf_sources.cache.clear()
+        loaded[:] = pdf_pages.load_pages(filename)
+        # Render the pages, so they're parsed as they would be written
+        for page in loaded:
+            page.obj
+        return []
+
+    def load_images():
+        image_dir = osp.join(dirname, 'images')
+        shutil.rmtree(image_dir, ignore_errors=True)
+        os.mkdir(image_dir)
+        filenames = synthetic_image_files(image_dir, min(pages, 256),
+                                          image_size)
+        pdf_sources.cache.clear()
+        for i, file_pages, error in pdf_pages.load_files(
+                filenames, processes=processes):
+            if error is not None:
+                raise error
+        return []
+
+    def transform():
+        stamp = pdf_pages.Page.from_file(filename)[0]
+        for i, page in enumerate(loaded):
+            if i % 2:
+                page.rotateRight()
+            page.merge(stamp, 36, 36, 'stamp')
+            page.obj
+        return []
+
+    def write():
+        output = osp.join(dirname, 'output.pdf')
+        pdf_pages.write_single(loaded, output)
+        return [output]
+
+    def extract():
+        image_dir = osp.join(dirname, 'extracted')
+        shutil.rmtree(image_dir, ignore_errors=True)
+        os.mkdir(image_dir)
+        pdf_images.extract_images_parallel(
+            pdf_pages.RenderedPages(loaded), osp.join(image_dir, 'IMG_'),
+            processes=processes)
+        return [osp.join(image_dir, name)
+                for name in os.listdir(image_dir)]
+
+    functions = {'load': load, 'load_images': load_images,
+                 'transform': transform, 'write': write, 'extract': extract}
+    for stage in stages:
+        if stage not in ('load', 'load_images') and not loaded:
+            load()
+        # Operations accumulate, so transforms are only timed once
+        results[stage] = measure(functions[stage],
+                                 1 if stage == 'transform' else repeat, trace)
+    return results
+
+
+def case_name(pages, shared_fonts, images):
+    return "{}p-{}-{}".format(pages, 'shared' if shared_fonts else 'unshared',
+                              '+'.join(images) or 'noimages')
+
+
+def compare(results, baseline, threshold=0.2):
+    """Compares results against a baseline, returning the regressions as
+    (case, stage, metric, baseline value, value): stages whose wall time,
+    traced memory peak or output size grew by more than `threshold`
+    (relative), and the whole run's peak RSS, reported with the case and
+    stage '-'. Cases missing from either side, or run with different
+    stages, and metrics that weren't measured, are ignored.
+    """
+    regressions = []
+    old = baseline.get('peak_rss')
+    new = results.get('peak_rss')
+    if old and new is not None and new > old * (1 + threshold):
+        regressions.append(('-', '-', 'peak_rss', old, new))
+    for case, case_results in sorted(results['cases'].items()):
+        case_baseline = baseline['cases'].get(case, {})
+        if case_baseline.get('stages') != case_results['stages']:
+            continue
+        for stage in stages:
+            if stage not in case_results:
+                continue
+            for metric in ('wall', 'peak_traced', 'output_bytes'):
+                old = case_baseline[stage].get(metric)
+                new = case_results[stage].get(metric)
+                if old and new is not None and new > old * (1 + threshold):
+                    regressions.append((case, stage, metric, old, new))
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        description="Times PyPDFTK's load, transform, write and extract "
+                    "stages on synthetic documents.")
+    parser.add_argument('--pages', nargs='+', type=int, default=[1, 1000],
+                        help="page counts of the generated documents "
+                             "(default: %(default)s)")
+    parser.add_argument('--unshared-fonts', action='store_true',
+                        help="give each page its own font object, instead "
+                             "of sharing one")
+    parser.add_argument('--images', nargs='*', choices=image_kinds,
+                        default=image_kinds,
+                        help="images on each page (default: all kinds)")
+    parser.add_argument('--image-size', type=int, default=256,
+                        help="image width and height, in pixels "
+                             "(default: %(default)s)")
+    parser.add_argument('--stages', nargs='+', choices=stages,
+                        default=stages, help="stages to time (default: all)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="times each stage is run, keeping the fastest "
+                             "(default: %(default)s)")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="number of processes used to convert images "
+                             "and extract images (default: number of CPUs)")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="record the peak memory allocated by each "
+                             "stage, with tracemalloc (slower)")
+    parser.add_argument('--output', metavar='FILE',
+                        help="save the results as JSON")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare the results against a JSON file saved "
+                             "with --output")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative growth over the baseline reported as "
+                             "a regression (default: %(default)s)")
+    return parser
+
+
+def run(args):
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'PyPDF2': pdf.__version__,
+               'cases': {}}
+    for pages in args.pages:
+        name = case_name(pages, not args.unshared_fonts, args.images)
+        dirname = tempfile.mkdtemp(prefix='pypdftk-benchmark-')
+        try:
+            results['cases'][name] = run_case(
+                dirname, pages, not args.unshared_fonts, args.images,
+                args.image_size, args.stages, args.repeat, args.jobs,
+                args.trace_memory)
+        finally:
+            pdf_sources.cache.clear()
+            shutil.rmtree(dirname, ignore_errors=True)
+        for stage in args.stages:
+            result = results['cases'][name][stage]
+            print("{:<40} {:<12} {:9.3f}s {:>8} MiB traced {:>12} "
+                  "bytes".format(
+                      name, stage, result['wall'],
+                      '-' if result['peak_traced'] is None
+                      else "{:.1f}".format(result['peak_traced'] / 2**20),
+                      result['output_bytes']))
+    # Only known for the whole process, which ran every case
+    results['peak_rss'] = peak_rss()
+    if results['peak_rss'] is not None:
+        print("Peak RSS of the whole run: {} MiB".format(
+            results['peak_rss'] // 2**20))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for case, stage, metric, old, new in regressions:
+            print("Regression: {} {} {}: {:.6g} -> {:.6g} ({:+.0%})".format(
+                case, stage, metric, old, new, new / old - 1),
+                file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+def main(argv=None):
+    parser = build_parser()
+    return run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Index of the pages' text and metadata (size, rotation, number of images and
+source file), for finding pages with queries such as
+    INVOICE landscape file:report*.pdf
+This module must not import Qt.
+
+Source files are indexed rather than pages: each PDF is read by a reader of
+its own (and by PyMuPDF for the text, when available, as it extracts it
+better), so indexing can run in the background while the pages' documents
+are being used, and doesn't need to be redone when pages are rotated,
+merged or reordered. A page's entry is made from its source page's and its
+operations when it's queried.
+
+Queries are terms that must all match, where a term is one of
+    word, "some words"     Text containing it, ignoring case
+    text:landscape         Text containing a word used as a keyword below
+    landscape, portrait    Orientation, as the page is shown
+    file:PATTERN           Source file name (wildcards allowed), or part of it
+    rotation:90            Rotation (0, 90, 180 or 270)
+    images>0               Number of images, compared with :, <, >, <=, >=
+    width<22, height>=29   Size as shown, in cm, compared the same way
+Terms starting with "-" match pages that don't match the rest of the term.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import os.path as osp
+import re
+import shlex
+import fnmatch
+import operator
+import threading
+import multiprocessing
+from concurrent import futures
+from io import BytesIO
+
+import PyPDF2 as pdf
+try:
+    import pymupdf as fitz
+except ImportError:
+    try:
+        import fitz  # PyMuPDF < 1.24
+    except ImportError:
+        fitz = None
+
+import pdf_images
+import pdf_sources
+import profiling
+
+
+# 1 PDF unit = 1/72 inches
+points_per_cm = 72 / 2.54
+
+
+def _normalized(text):
+    return ' '.join(text.split()).casefold()
+
+
+def _fitz_texts(filename, data=None):
+    if data is not None:
+        document = fitz.open(stream=data, filetype='pdf')
+    else:
+        document = fitz.open(filename)
+    try:
+        return [page.get_text() for page in document]
+    finally:
+        document.close()
+
+
+def index_file(filename, data=None):
+    """Returns the (text, width, height, rotation, number of images) of each
+    page of a PDF file, or of `data` if given (the file's contents as it was
+    loaded), with the text normalized for searching and the size in points,
+    before rotation.
+    """
+    with profiling.span('index'):
+        texts = _fitz_texts(filename, data) if fitz is not None else None
+        if data is not None:
+            stream = BytesIO(data)
+        else:
+            stream = pdf_sources.open_mapped(filename)
+        try:
+            reader = pdf.PdfFileReader(stream, strict=False)
+            if reader.isEncrypted:
+                reader.decrypt('')
+            records = []
+            for page_number in range(reader.getNumPages()):
+                page = reader.getPage(page_number)
+                if texts is not None:
+                    text = texts[page_number]
+                else:
+                    try:
+                        text = page.extractText()
+                    except Exception:  # Unsupported content, for PyPDF2
+                        text = ''
+                box = page.mediaBox
+                records.append((_normalized(text), float(box.getWidth()),
+                                float(box.getHeight()),
+                                int(page.get('/Rotate', 0)) % 360,
+                                pdf_images.image_count(page)))
+        finally:
+            stream.close()
+    profiling.count('pages_indexed', len(records))
+    return records
+
+
+class PageEntry(object):
+    """What the index knows about a page, as it is shown: its text, size
+    (points), rotation (degrees clockwise) and number of images, including
+    those of the pages merged with it, and its source file.
+    """
+    def __init__(self, name, filename, text, width, height, rotation,
+                 images):
+        self.name = name
+        self.filename = filename
+        self.text = text
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.images = images
+
+    @property
+    def landscape(self):
+        return self.width > self.height
+
+
+class PageIndex(object):
+    """The indexed source files, shared by all their pages. Pages are
+    searched with `search()`, once their files are indexed with `update()`.
+    Thread safe.
+    """
+    def __init__(self):
+        # Source key -> records of its pages (see `index_file`), or None if
+        # it couldn't be indexed
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(source):
+        if source.image is not None:
+            return ('image', source.origin, source.image)
+        # The file as it was loaded, which documents whose file changed
+        # since are indexed as (see `jobs`)
+        return source.fingerprint or ('document', id(source))
+
+    def jobs(self, pages):
+        """Returns the source files of `pages` that aren't indexed yet, as
+        (key, filename, data) triples, where data is None unless the file
+        changed since it was loaded (see SourceDocument.changed), and the
+        document is read from its data instead. Images are indexed right
+        away, since nothing needs to be read from them.
+        """
+        jobs = {}
+        with self._lock:
+            for page in pages:
+                for source in page.sources:
+                    key = self._key(source)
+                    if key in self._sources or key in jobs:
+                        continue
+                    if source.image is not None:
+                        width, height = source.image[0]
+                        self._sources[key] = [('', width * points_per_cm,
+                                               height * points_per_cm, 0, 1)]
+                    elif source.changed:
+                        jobs[key] = (source.origin, source.data())
+                    else:
+                        jobs[key] = (source.filename, None)
+        return [(key, filename, data)
+                for key, (filename, data) in jobs.items()]
+
+    def run(self, jobs, processes=None, progress=None):
+        """Indexes the files of `jobs` (see `jobs()`), in a pool of
+        `processes` (default: number of CPUs) if there are several.
+        `progress(done, total)` is called as files are indexed; if it
+        raises, the files not indexed yet are skipped.
+
+        Returns the files that couldn't be indexed, as (filename, error)
+        pairs. They aren't retried: their pages just don't match queries.
+        """
+        processes = processes or multiprocessing.cpu_count()
+        total = len(jobs)
+        failures = []
+        if processes == 1 or total < 2:
+            for done, (key, filename, data) in enumerate(jobs):
+                try:
+                    records = index_file(filename, data)
+                except Exception as e:
+                    failures.append((filename, e))
+                    self._add(key, None)
+                else:
+                    self._add(key, records)
+                if progress is not None:
+                    progress(done + 1, total)
+            return failures
+
+        executor = futures.ProcessPoolExecutor(
+            min(processes, total), mp_context=pdf_images.pool_context())
+        try:
+            keys = {executor.submit(profiling.call_recorded, index_file,
+                                    filename, data): (key, filename)
+                    for key, filename, data in jobs}
+            for done, future in enumerate(futures.as_completed(keys)):
+                key, filename = keys[future]
+                try:
+                    records, recorded = future.result()
+                except Exception as e:
+                    failures.append((filename, e))
+                    self._add(key, None)
+                else:
+                    profiling.merge(recorded)
+                    self._add(key, records)
+                if progress is not None:
+                    progress(done + 1, total)
+        except BaseException:
+            # Don't start the remaining files, e.g. when cancelled
+            executor.shutdown(cancel_futures=True)
+            raise
+        executor.shutdown()
+        return failures
+
+    def update(self, pages, processes=None, progress=None):
+        """Indexes the source files of `pages` that aren't indexed yet,
+        returning those that couldn't be, as `run()` does.
+        """
+        return self.run(self.jobs(pages), processes, progress)
+
+    def _add(self, key, records):
+        with self._lock:
+            self._sources[key] = records
+
+    def clear(self):
+        with self._lock:
+            self._sources.clear()
+
+    def _record(self, source, page_number):
+        with self._lock:
+            records = self._sources.get(self._key(source))
+        if records is None or page_number >= len(records):
+            return None
+        return records[page_number]
+
+    def entry(self, page):
+        """Returns the PageEntry of a page, or None if its files aren't
+        indexed.
+        """
+        record = self._record(page.source, page.page_number)
+        if record is None:
+            return None
+        text, width, height, rotation, images = record
+        texts = [text]
+        for op in page.ops:
+            if op[0] == 'rotate':
+                rotation = (rotation + op[1]) % 360
+                continue
+            other = self.entry(op[1])
+            if other is None:
+                return None
+            texts.append(other.text)
+            images += other.images
+            if op[0] == 'background':
+                # The page is drawn upright on a blank page of its size
+                if rotation in (90, 270):
+                    width, height = height, width
+                rotation = 0
+        if rotation in (90, 270):
+            width, height = height, width
+        return PageEntry(page.name, page.source.origin,
+                         ' '.join(text for text in texts if text), width,
+                         height, rotation, images)
+
+    def search(self, pages, query):
+        """Returns the indexes of the pages matching `query`, a query string
+        or a function of a PageEntry (see `parse_query`). Pages whose files
+        aren't indexed don't match.
+        """
+        if not callable(query):
+            query = parse_query(query)
+        matches = []
+        for i, page in enumerate(pages):
+            entry = self.entry(page)
+            if entry is not None and query(entry):
+                matches.append(i)
+        return matches
+
+
+_comparisons = {':': operator.eq, '=': operator.eq, '<': operator.lt,
+                '>': operator.gt, '<=': operator.le, '>=': operator.ge}
+_numbers = {
+    'images': lambda entry: entry.images,
+    'rotation': lambda entry: entry.rotation,
+    'width': lambda entry: entry.width / points_per_cm,
+    'height': lambda entry: entry.height / points_per_cm,
+}
+_term = re.compile(r'(\w+)(<=|>=|:|=|<|>)(.*)$')
+
+
+def _text_term(text):
+    text = _normalized(text)
+    return lambda entry: text in entry.text
+
+
+def _file_term(pattern):
+    pattern = pattern.casefold()
+    if not any(c in pattern for c in '*?['):
+        return lambda entry: pattern in osp.basename(entry.filename).casefold()
+    return lambda entry: fnmatch.fnmatchcase(
+        osp.basename(entry.filename).casefold(), pattern)
+
+
+def _number_term(key, comparison, value):
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError("{} must be compared with a number, not "
+                         "'{}'".format(key, value))
+    number = _numbers[key]
+    return lambda entry: comparison(round(number(entry), 1), value)
+
+
+def _parse_term(term):
+    if term.casefold() == 'landscape':
+        return lambda entry: entry.landscape
+    if term.casefold() == 'portrait':
+        return lambda entry: not entry.landscape
+    match = _term.match(term)
+    if match is None:
+        return _text_term(term)
+    key, comparison, value = match.groups()
+    key = key.casefold()
+    if key == 'text' and comparison == ':':
+        return _text_term(value)
+    if key == 'file' and comparison == ':':
+        return _file_term(value)
+    if key in _numbers:
+        return _number_term(key, _comparisons[comparison], value)
+    raise ValueError("unknown query term '{}'".format(term))
+
+
+def parse_query(query):
+    """Returns a function of a PageEntry telling if it matches `query` (see
+    the module's documentation). Raises ValueError if the query is invalid.
+    """
+    terms = []
+    for term in shlex.split(query):
+        negated = term.startswith('-') and len(term) > 1
+        function = _parse_term(term[1:] if negated else term)
+        if negated:
+            function = (lambda function: lambda entry: not function(entry))(
+                function)
+        terms.append(function)
+    if not terms:
+        raise ValueError("empty query")
+    return lambda entry: all(term(entry) for term in terms)
+
+
+def split_at(count, starts):
+    """Groups `count` pages into runs of page indexes, starting a new run at
+    each index in `starts` (e.g. the pages matching a query). The pages
+    before the first start are a run of their own.
+    """
+    groups = []
+    starts = set(starts)
+    for i in range(count):
+        if not groups or i in starts:
+            groups.append([])
+        groups[-1].append(i)
+    return groups
+
+
+index = PageIndex()
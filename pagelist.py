@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Model and view of the loaded pages. The model only keeps an array of page
+ids in display order, and every change (insertions, removals, moves) is
+applied to whole ranges at once, so sessions with many thousands of pages
+stay responsive.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import array
+import itertools
+
+from qtpy import QtCore, QtWidgets
+
+
+def runs(rows):
+    """Groups sorted rows into (first, last) runs of consecutive rows."""
+    for k, group in itertools.groupby(enumerate(rows),
+                                      lambda pair: pair[1] - pair[0]):
+        group = list(group)
+        yield group[0][1], group[-1][1]
+
+
+class PageListModel(QtCore.QAbstractListModel):
+    """Pages in display order, identified by integer ids.
+
+    Thumbnails are kept with the page name they were rendered for, so
+    pages whose name changed since (e.g. rotated pages) can be re-rendered.
+    """
+    def __init__(self, parent=None):
+        super(PageListModel, self).__init__(parent)
+        self._ids = array.array('q')
+        self._pages = {}  # id -> Page
+        self._icons = {}  # id -> (page name, QIcon)
+        self._rows = None  # id -> row, built when needed
+        self._next_id = 0
+        # Shown until the thumbnail is rendered, so all rows are the same
+        # size (see QListView.uniformItemSizes). None for no thumbnails.
+        self.placeholder_icon = None
+
+    ### QAbstractListModel interface
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._ids)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        page_id = self._ids[index.row()]
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.ToolTipRole):
+            return self._pages[page_id].name
+        elif role == QtCore.Qt.DecorationRole:
+            icon = self._icons.get(page_id)
+            return icon[1] if icon is not None else self.placeholder_icon
+        elif role == QtCore.Qt.UserRole:
+            return page_id
+        return None
+
+    def flags(self, index):
+        flags = super(PageListModel, self).flags(index)
+        if index.isValid():
+            return flags | QtCore.Qt.ItemIsDragEnabled
+        return flags | QtCore.Qt.ItemIsDropEnabled
+
+    def supportedDropActions(self):
+        return QtCore.Qt.MoveAction
+
+    def sort(self, column=0, order=QtCore.Qt.AscendingOrder):
+        names = [self._pages[page_id].name for page_id in self._ids]
+        order = sorted(range(len(names)), key=names.__getitem__,
+                       reverse=order == QtCore.Qt.DescendingOrder)
+        self.permute(order)
+
+    ### Pages
+    def page(self, row):
+        return self._pages[self._ids[row]]
+
+    def page_id(self, row):
+        return self._ids[row]
+
+    def pages(self, rows=None):
+        """The pages in `rows` (default: all), in display order."""
+        if rows is None:
+            return [self._pages[page_id] for page_id in self._ids]
+        return [self._pages[self._ids[row]] for row in rows]
+
+    def page_by_id(self, page_id):
+        return self._pages.get(page_id)
+
+    def row(self, page_id):
+        """Row of a page id, or -1 if it isn't in the model."""
+        if self._rows is None:
+            self._rows = {page_id: row for row, page_id in enumerate(self._ids)}
+        return self._rows.get(page_id, -1)
+
+    def insert_pages(self, row, pages):
+        """Inserts pages before `row`, returning the range of their rows."""
+        if not pages:
+            return range(row, row)
+        ids = array.array('q', range(self._next_id,
+                                     self._next_id + len(pages)))
+        self._next_id += len(pages)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row + len(pages) - 1)
+        self._pages.update(zip(ids, pages))
+        self._ids[row:row] = ids
+        self._rows = None
+        self.endInsertRows()
+        return range(row, row + len(pages))
+
+    def remove_rows(self, rows):
+        """Removes the pages in `rows`, one run of consecutive rows at a
+        time.
+        """
+        for first, last in reversed(list(runs(sorted(rows)))):
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            for page_id in self._ids[first:last + 1]:
+                del self._pages[page_id]
+                self._icons.pop(page_id, None)
+            del self._ids[first:last + 1]
+            self._rows = None
+            self.endRemoveRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self._ids = array.array('q')
+        self._pages = {}
+        self._icons = {}
+        self._rows = None
+        self.endResetModel()
+
+    def pages_changed(self, rows):
+        """Notifies views that the pages in `rows` changed (e.g. their
+        names).
+        """
+        for first, last in runs(sorted(rows)):
+            self.dataChanged.emit(self.index(first), self.index(last))
+
+    def set_icon(self, page_id, name, icon):
+        """Sets the thumbnail of a page, rendered when it was named `name`.
+        `icon` may be None, if it couldn't be rendered.
+        """
+        self._icons[page_id] = (name, icon)
+        row = self.row(page_id)
+        if row >= 0:
+            self.pages_changed([row])
+
+    def needs_icon(self, row):
+        page_id = self._ids[row]
+        icon = self._icons.get(page_id)
+        return icon is None or icon[0] != self._pages[page_id].name
+
+    ### Moves
+    def permute(self, order):
+        """Rearranges the rows so that the new row i is the old row
+        `order[i]`, keeping the views' selection and current row on the
+        same pages.
+        """
+        self.layoutAboutToBeChanged.emit()
+        new_rows = array.array('q', [0]) * len(order)
+        for new_row, old_row in enumerate(order):
+            new_rows[old_row] = new_row
+        old_indexes = self.persistentIndexList()
+        self.changePersistentIndexList(
+            old_indexes, [self.index(new_rows[index.row()])
+                          for index in old_indexes])
+        self._ids = array.array('q', (self._ids[row] for row in order))
+        self._rows = None
+        self.layoutChanged.emit()
+
+    def move_rows(self, rows, to_row):
+        """Moves `rows`, keeping their order, so they're inserted before
+        what is now `to_row`. Returns the range of their new rows.
+        """
+        moved = set(rows)
+        rows = sorted(moved)
+        before = [row for row in range(to_row) if row not in moved]
+        after = [row for row in range(to_row, len(self._ids))
+                 if row not in moved]
+        self.permute(before + rows + after)
+        return range(len(before), len(before) + len(rows))
+
+    def shift_rows(self, rows, up=True):
+        """Moves each of `rows` one row up (or down), past the unselected
+        row next to it. Rows already against the top (bottom) stay there.
+        Returns the new rows.
+        """
+        moved = set(rows)
+        order = list(range(len(self._ids)))
+        step = -1 if up else 1
+        edge = 0 if up else len(order) - 1
+        for row in sorted(moved, reverse=not up):
+            if row == edge:
+                edge -= step
+                continue
+            order[row + step], order[row] = order[row], order[row + step]
+        self.permute(order)
+        return sorted(new_row for new_row, old_row in enumerate(order)
+                      if old_row in moved)
+
+
+class PageListView(QtWidgets.QListView):
+    """List of pages, rearranged by dragging them."""
+    def __init__(self, parent=None):
+        super(PageListView, self).__init__(parent)
+        self.setDragDropMode(self.DragDrop)
+        self.setDefaultDropAction(QtCore.Qt.MoveAction)
+        self.setSelectionMode(self.ExtendedSelection)
+        self.setIconSize(QtCore.QSize(72, 72))
+        # Only the visible rows are laid out
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(self.Batched)
+        self.setModel(PageListModel(self))
+
+    def count(self):
+        return self.model().rowCount()
+
+    def selected_rows(self):
+        """Selected rows, sorted."""
+        rows = []
+        for selection_range in self.selectionModel().selection():
+            rows.extend(range(selection_range.top(),
+                              selection_range.bottom() + 1))
+        rows.sort()
+        return rows
+
+    def select_rows(self, rows, clear=True):
+        selection = QtCore.QItemSelection()
+        model = self.model()
+        for first, last in runs(sorted(rows)):
+            selection.select(model.index(first), model.index(last))
+        flags = QtCore.QItemSelectionModel.Select
+        if clear:
+            flags |= QtCore.QItemSelectionModel.Clear
+        self.selectionModel().select(selection, flags)
+
+    def drop_row(self, pos):
+        index = self.indexAt(pos)
+        if not index.isValid():
+            return self.count()
+        if pos.y() > self.visualRect(index).center().y():
+            return index.row() + 1
+        return index.row()
+
+    def dropEvent(self, event):
+        if event.source() is not self:
+            return super(PageListView, self).dropEvent(event)
+        # Move the pages here, instead of letting the view insert copies and
+        # remove the originals
+        rows = self.model().move_rows(self.selected_rows(),
+                                      self.drop_row(event.pos()))
+        self.select_rows(rows)
+        event.setDropAction(QtCore.Qt.CopyAction)
+        event.accept()
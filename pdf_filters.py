@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Stream filter decoding (pg 65). Each filter has a decoder, registered by
+name, that takes an iterable of byte chunks and yields decoded chunks, so a
+filter chain is decoded stage by stage without holding a full intermediate
+copy of the stream. Image formats (DCT, JPX, CCITT fax, JBIG2) aren't
+decoded: they end the chain, and the data is left in that format.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import base64
+import binascii
+import itertools
+import zlib
+
+
+chunk_size = 2**16
+
+decoders = {}
+
+# Abbreviations used in inline images (pg 353)
+aliases = {'/AHx': '/ASCIIHexDecode', '/A85': '/ASCII85Decode',
+           '/LZW': '/LZWDecode', '/Fl': '/FlateDecode',
+           '/RL': '/RunLengthDecode', '/CCF': '/CCITTFaxDecode',
+           '/DCT': '/DCTDecode'}
+
+image_filters = {'/DCTDecode', '/JPXDecode', '/CCITTFaxDecode',
+                 '/JBIG2Decode'}
+
+_whitespace = b' \t\n\r\f\x00'
+
+
+def canonical(name):
+    return aliases.get(name, name)
+
+
+def decoder(*names):
+    """Registers a decoder function, `decoder(chunks, parms)`, for the
+    filters `names`.
+    """
+    def register(function):
+        for name in names:
+            decoders[name] = function
+        return function
+    return register
+
+
+def supported(name):
+    return canonical(name) in decoders
+
+
+def is_image_filter(name):
+    return canonical(name) in image_filters
+
+
+def filter_parms(decode_parms, i):
+    """Returns the /DecodeParms dictionary of the `i`-th filter, as
+    /DecodeParms is either a dictionary or an array with one per filter.
+    """
+    if isinstance(decode_parms, list):
+        decode_parms = decode_parms[i] if i < len(decode_parms) else None
+    return decode_parms or {}
+
+
+def chunked(data, size=None):
+    """Splits data into chunks, without copying it."""
+    size = size or chunk_size
+    view = memoryview(data)
+    return (view[i:i + size] for i in range(0, len(view), size))
+
+
+def decode(data, filters, decode_parms=None):
+    """Decodes `data` with `filters` in order, yielding the decoded chunks.
+    Raises NotImplementedError if a filter has no decoder.
+    """
+    chunks = chunked(data)
+    for i, name in enumerate(filters):
+        function = decoders.get(canonical(name))
+        if function is None:
+            raise NotImplementedError("Unsupported filter {}".format(name))
+        chunks = function(chunks, filter_parms(decode_parms, i))
+    return chunks
+
+
+@decoder('/ASCIIHexDecode')
+def ascii_hex_decode(chunks, parms):
+    pending = b''
+    for chunk in chunks:
+        chunk = bytes(chunk)
+        end = chunk.find(b'>')
+        if end >= 0:
+            chunk = chunk[:end]
+        digits = pending + chunk.translate(None, _whitespace)
+        even = len(digits) & ~1
+        yield binascii.unhexlify(digits[:even])
+        pending = digits[even:]
+        if end >= 0:
+            break
+    if pending:  # Odd number of digits: the last one is followed by 0
+        yield binascii.unhexlify(pending + b'0')
+
+
+@decoder('/ASCII85Decode')
+def ascii85_decode(chunks, parms):
+    pending = b''
+    first = True
+    for chunk in chunks:
+        chunk = bytes(chunk)
+        if first:  # Skip the optional '<~' prefix
+            chunk, pending = pending + chunk.lstrip(_whitespace), b''
+            if chunk in (b'', b'<'):
+                pending = chunk
+                continue
+            if chunk.startswith(b'<~'):
+                chunk = chunk[2:]
+            first = False
+        # '~' isn't one of the digits, so it always starts the EOD marker
+        end = chunk.find(b'~')
+        if end >= 0:
+            chunk = chunk[:end]
+        digits = pending + (chunk.translate(None, _whitespace)
+                            .replace(b'z', b'!!!!!'))
+        whole = len(digits) - len(digits) % 5
+        yield base64.a85decode(digits[:whole])
+        pending = digits[whole:]
+        if end >= 0:
+            break
+    if pending:
+        yield base64.a85decode(pending)
+
+
+@decoder('/FlateDecode')
+def flate_decode(chunks, parms):
+    return predict(_inflate(chunks), parms)
+
+
+def _inflate(chunks):
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        # Limit the output per call, so a small chunk that expands a lot
+        # (e.g. a blank scan) doesn't produce a huge one
+        while chunk and not decompressor.eof:
+            yield decompressor.decompress(chunk, chunk_size)
+            chunk = decompressor.unconsumed_tail
+        if decompressor.eof:
+            break
+    yield decompressor.flush()
+
+
+@decoder('/LZWDecode')
+def lzw_decode(chunks, parms):
+    return predict(_lzw(chunks, int(parms.get('/EarlyChange', 1))), parms)
+
+
+def _lzw(chunks, early_change):
+    clear, eod = 256, 257
+    table = [bytes([i]) for i in range(256)] + [b'', b'']
+    code_length = 9
+    previous = None
+    buffer = 0
+    bits = 0
+    for chunk in chunks:
+        out = bytearray()
+        for byte in bytes(chunk):
+            buffer = (buffer << 8) | byte
+            bits += 8
+            while bits >= code_length:
+                bits -= code_length
+                code = buffer >> bits
+                buffer &= (1 << bits) - 1
+                if code == clear:
+                    del table[258:]
+                    code_length = 9
+                    previous = None
+                    continue
+                if code == eod:
+                    yield bytes(out)
+                    return
+                if previous is None:
+                    entry = table[code]
+                elif code < len(table):
+                    entry = table[code]
+                    table.append(previous + entry[:1])
+                else:  # The code being defined by this very step
+                    entry = previous + previous[:1]
+                    table.append(entry)
+                out += entry
+                previous = entry
+                if len(table) + early_change >= 1 << code_length and \
+                        code_length < 12:
+                    code_length += 1
+        yield bytes(out)
+
+
+@decoder('/RunLengthDecode')
+def run_length_decode(chunks, parms):
+    pending = b''
+    for chunk in chunks:
+        data = pending + bytes(chunk)
+        out = bytearray()
+        i = 0
+        while i < len(data):
+            length = data[i]
+            if length == 128:  # EOD
+                yield bytes(out)
+                return
+            elif length < 128:
+                if i + 1 + length + 1 > len(data):
+                    break
+                out += data[i + 1:i + length + 2]
+                i += length + 2
+            else:
+                if i + 1 >= len(data):
+                    break
+                out += data[i + 1:i + 2] * (257 - length)
+                i += 2
+        pending = data[i:]
+        yield bytes(out)
+
+
+def _add_bytes(a, b, low=None, high=None):
+    """Adds two byte strings of the same length, byte by byte, modulo 256,
+    using integer arithmetic over the whole strings.
+    """
+    n = len(a)
+    if low is None:
+        low = int.from_bytes(b'\x7f' * n, 'big')
+        high = int.from_bytes(b'\x80' * n, 'big')
+    x = int.from_bytes(a, 'big')
+    y = int.from_bytes(b, 'big')
+    return (((x & low) + (y & low)) ^ ((x ^ y) & high)).to_bytes(n, 'big')
+
+
+def predict(chunks, parms):
+    """Reverses the TIFF (2) or PNG (10-15) predictor given in `parms`
+    (pg 76), row by row.
+    """
+    predictor = int(parms.get('/Predictor', 1))
+    if predictor == 1:
+        return chunks
+    colors = int(parms.get('/Colors', 1))
+    bits = int(parms.get('/BitsPerComponent', 8))
+    columns = int(parms.get('/Columns', 1))
+    row_length = (colors * bits * columns + 7) // 8
+    if predictor == 2:
+        if bits != 8:
+            raise NotImplementedError("TIFF predictor with {} bits per "
+                                      "component".format(bits))
+        return _rows(chunks, row_length, _tiff_row, colors)
+    return _rows(chunks, row_length + 1, _png_row,
+                 max(1, colors * bits // 8), bytes(row_length))
+
+
+def _rows(chunks, length, function, *state):
+    """Yields the chunks transformed by `function(row, *state)`, applied to
+    rows of `length` bytes. The function returns the transformed row and
+    the new state.
+    """
+    pending = b''
+    for chunk in chunks:
+        data = pending + bytes(chunk)
+        whole = len(data) - len(data) % length
+        out = []
+        for i in range(0, whole, length):
+            row, state = function(data[i:i + length], *state)
+            out.append(row)
+        pending = data[whole:]
+        yield b''.join(out)
+
+
+def _tiff_row(row, colors):
+    row = bytearray(row)
+    for component in range(colors):
+        row[component::colors] = bytes(
+            value & 0xff
+            for value in itertools.accumulate(row[component::colors]))
+    return bytes(row), (colors,)
+
+
+def _png_row(row, bpp, previous):
+    kind, row = row[0], bytearray(row[1:])
+    if kind == 1:  # Sub
+        for i in range(bpp, len(row)):
+            row[i] = (row[i] + row[i - bpp]) & 0xff
+    elif kind == 2:  # Up
+        row = _add_bytes(bytes(row), previous)
+    elif kind == 3:  # Average
+        for i in range(len(row)):
+            left = row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+    elif kind == 4:  # Paeth
+        for i in range(len(row)):
+            a = row[i - bpp] if i >= bpp else 0
+            b = previous[i]
+            c = previous[i - bpp] if i >= bpp else 0
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            if pa <= pb and pa <= pc:
+                predicted = a
+            elif pb <= pc:
+                predicted = b
+            else:
+                predicted = c
+            row[i] = (row[i] + predicted) & 0xff
+    row = bytes(row)
+    return row, (bpp, row)
@@ -16,8 +16,18 @@ TIFF format and tags: http://www.awaresystems.be/imaging/tiff/faq.html
 @author: Ronan Paixão, with some code from
     http://stackoverflow.com/questions/2693820/extract-images-from-pdf-without-resampling-in-python
 """
+from __future__ import print_function
+
+import sys
 import struct
-import base64
+import collections
+import traceback
+import hashlib
+import csv
+import json
+import threading
+import multiprocessing
+from concurrent import futures
 
 from PIL import Image
 try:
@@ -30,6 +40,12 @@ from io import BytesIO
 
 import PyPDF2 as pdf
 
+import pdf_filters
+import profiling
+
+
+# Formats images are extracted in: raw pixels or the image's own encoding
+image_formats = {'raw', '/DCTDecode', '/JPXDecode', '/CCITTFaxDecode'}
 
 img_modes = {'/DeviceRGB': 'RGB', '/DefaultRGB': 'RGB',
              '/DeviceCMYK': 'CMYK', '/DefaultCMYK': 'CMYK',
@@ -56,143 +72,674 @@ def tiff_header_for_CCITT(width, height, img_size, CCITT_group=4):
                        )
 
 
-def extract_images(page, filename_prefix="IMG_", start_index=0):
+def icc_app2_segments(profile):
+    """Returns the APP2 marker segments embedding an ICC profile in a JPEG
+    file (ICC.1 Annex B.4), split in as many segments as needed.
+    """
+    size = 65519  # Segment length, minus the length and the identifier
+    parts = [profile[i:i + size] for i in range(0, len(profile), size)]
+    return b''.join(b'\xff\xe2' + struct.pack('>H', len(part) + 16) +
+                    b'ICC_PROFILE\0' + struct.pack('BB', n + 1, len(parts)) +
+                    part for n, part in enumerate(parts))
 
-    if '/XObject' not in page['/Resources']:
-        return start_index
-    xObject = page['/Resources']['/XObject'].getObject()
 
-    i = start_index
+def _icc_position(head):
+    """Returns where the ICC profile segments go in a JPEG file starting
+    with `head`: after the APP0 (JFIF) and APP1 (Exif) segments. Returns
+    None if more data is needed, and -1 if the file already has a profile
+    or isn't a JPEG file.
+    """
+    if len(head) < 2:
+        return None
+    if not head.startswith(b'\xff\xd8'):  # SOI
+        return -1
+    pos = 2
+    while True:
+        if len(head) < pos + 16:
+            return None
+        if head[pos] != 0xff:
+            return -1
+        marker = head[pos + 1]
+        if marker == 0xe2 and head[pos + 4:pos + 16] == b'ICC_PROFILE\0':
+            return -1
+        if marker not in (0xe0, 0xe1):
+            return pos
+        pos += 2 + struct.unpack('>H', head[pos + 2:pos + 4])[0]
+
+
+def jpeg_with_icc(chunks, profile):
+    """Yields the chunks of a JPEG file with an ICC profile spliced in,
+    without decoding the image. Files that already have a profile are left
+    as they are.
+    """
+    chunks = iter(chunks)
+    head = b''
+    pos = None
+    for chunk in chunks:
+        head += bytes(chunk)
+        pos = _icc_position(head)
+        if pos is not None:
+            break
+    if pos is None or pos < 0:
+        yield head
+    else:
+        yield head[:pos] + icc_app2_segments(profile) + head[pos:]
+    for chunk in chunks:
+        yield chunk
+
+
+def _write_chunks(filename, chunks):
+    with open(filename, 'wb', buffering=2**20) as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def expand_palette(data, size, bits, base_mode, lookup):
+    """Expands the palette indexes of an /Indexed image into an image of
+    `base_mode` ('L', 'RGB', 'CMYK', 'RGBA'...).
+
+    `bits` is the /BitsPerComponent of the indexes (1, 2, 4 or 8), packed
+    in byte-aligned rows. Each band is mapped through a lookup table, so
+    the expansion runs at native speed.
+    """
+    n = Image.getmodebands(base_mode)
+    lookup = bytes(lookup[:256 * n]).ljust(256 * n, b'\0')
+    rawmode = 'P' if bits == 8 else 'P;{}'.format(bits)
+    indexes = Image.frombytes('P', size, data, 'raw', rawmode)
+    if base_mode in ('RGB', 'RGBA'):
+        # Pillow's palettes hold these, so it's a single conversion
+        indexes.putpalette(lookup, base_mode)
+        return indexes.convert(base_mode)
+    # The indexes, one per byte, without a palette applied
+    if bits == 8:
+        indexes = Image.frombytes('L', size, data)
+    else:
+        indexes = Image.frombytes('L', size, indexes.tobytes())
+    bands = [indexes.point(list(lookup[band::n])) for band in range(n)]
+    if n == 1:
+        return bands[0]
+    return Image.merge(base_mode, bands)
+
+
+def _plain(obj):
+    """Resolves a PDF object into plain Python objects, which can be sent to
+    other processes.
+    """
+    obj = obj.getObject()
+    if isinstance(obj, pdf.generic.StreamObject):
+        return obj.getData()
+    elif isinstance(obj, pdf.generic.DictionaryObject):
+        return dict((str(k), _plain(v)) for k, v in obj.items())
+    elif isinstance(obj, pdf.generic.ArrayObject):
+        return [_plain(v) for v in obj]
+    elif isinstance(obj, pdf.generic.NameObject):
+        return str(obj)
+    elif isinstance(obj, (pdf.generic.ByteStringObject,
+                          pdf.generic.TextStringObject)):
+        return bytes(obj.original_bytes)
+    elif isinstance(obj, pdf.generic.BooleanObject):
+        return obj.value
+    elif isinstance(obj, pdf.generic.NullObject):
+        return None
+    elif isinstance(obj, pdf.generic.FloatObject):
+        return float(obj)
+    elif isinstance(obj, pdf.generic.NumberObject):
+        return int(obj)
+    return obj
+
+
+class ImageJob(object):
+    """An image XObject resolved into plain Python objects, so that it can be
+    decoded and written in another process.
+    """
+    def __init__(self, xobject, name, page_number=0, ref=None):
+        self.name = str(name)
+        self.page_number = page_number
+        # Indirect reference of the XObject, as (reader id, idnum, generation)
+        self.ref = ref
+        self.size = (int(xobject['/Width']), int(xobject['/Height']))
+        self.bits = int(xobject.get('/BitsPerComponent', 8))
+        filt = xobject.get('/Filter', 'raw')
+        if isinstance(filt, list):
+            self.filters = [str(f) for f in filt]
+        elif filt == 'raw':
+            self.filters = []
+        else:
+            self.filters = [str(filt)]
+        self.decode_parms = _plain(xobject.get('/DecodeParms',
+                                               pdf.generic.NullObject()))
+        self.data = xobject._data
+
+        # Images encoded in a format saved as is (JPEG, JPEG 2000, fax)
+        # have their own filter last; any filters before it are decoded.
+        # Other images are decoded to raw pixels.
+        self.filter = 'raw'
+        self.decode_filters = self.filters
+        self.filter_parms = {}
+        if self.filters and pdf_filters.is_image_filter(self.filters[-1]):
+            self.filter = pdf_filters.canonical(self.filters[-1])
+            self.decode_filters = self.filters[:-1]
+            self.filter_parms = pdf_filters.filter_parms(
+                self.decode_parms, len(self.filters) - 1)
+        if (self.filter not in image_formats or
+                not all(pdf_filters.supported(f) for f in self.decode_filters)):
+            self.filter = None
+
+        color_space = xobject.get('/ColorSpace')
+        if color_space is not None:
+            color_space = color_space.getObject()
+        self.base = self.hival = self.lookup = None
+        self.icc_components = self.icc_profile = None
+        if isinstance(color_space, pdf.generic.ArrayObject) and color_space[0] == '/Indexed':
+            color_space, base, hival, lookup = [v.getObject() for v in color_space] # pg 262
+            if isinstance(base, pdf.generic.ArrayObject) and base[0] == '/ICCBased':
+                components = int(base[1].getObject()['/N'])
+                base = {1: '/DeviceGray', 3: '/DeviceRGB',
+                        4: '/DeviceCMYK'}[components]
+            self.base = _plain(base)
+            self.hival = int(hival)
+            self.lookup = _plain(lookup)
+        if isinstance(color_space, pdf.generic.ArrayObject) and color_space[0] == '/ICCBased':
+            color_space, components = [v.getObject() for v in color_space] # pg 274
+            self.icc_components = int(components['/N'])
+            self.icc_profile = components.getData()
+        self.color_space = _plain(color_space)
+
+        self.smask = None
+        if '/SMask' in xobject:  # Soft mask (pg 341)
+            self.smask = ImageJob(xobject['/SMask'].getObject(), '/SMask',
+                                  page_number)
+
+    def chunks(self):
+        """Yields the data, decoded up to the image's own format (see
+        `filter`), in chunks.
+        """
+        return pdf_filters.decode(self.data, self.decode_filters,
+                                  self.decode_parms)
+
+    def decoded(self):
+        """Returns the data, decoded up to the image's own format."""
+        if not self.decode_filters:
+            return self.data
+        return b''.join(self.chunks())
+
+    def digest(self):
+        """Returns a hash of the raw stream and of everything else that
+        affects the extracted image, so identical images hash the same.
+        """
+        h = hashlib.sha1(self.data)
+        h.update(repr((self.size, self.bits, self.filters, self.decode_parms,
+                       self.color_space, self.base, self.hival,
+                       self.icc_components)).encode('utf-8'))
+        for extra in (self.lookup, self.icc_profile):
+            h.update(extra if isinstance(extra, bytes) else repr(extra).encode('utf-8'))
+        if self.smask is not None:
+            h.update(self.smask.digest().encode('ascii'))
+        return h.hexdigest()
+
+
+def image_jobs(page, page_number=0):
+    """Returns the jobs for extracting the images of a page, in the order the
+    images are extracted. Images whose filter chain isn't supported have a
+    `filter` of None, and can't be extracted.
+    """
+    jobs = []
+    _resource_image_jobs(page['/Resources'], page_number, jobs, '', set())
+    return jobs
+
+
+def _resource_image_jobs(resources, page_number, jobs, prefix, forms):
+    """Appends the jobs for the images in `resources` to `jobs`, followed by
+    those of the Form XObjects in it (e.g. stamps), which are named after
+    the form they're in. `forms` holds the forms already visited.
+    """
+    resources = resources.getObject()
+    if '/XObject' not in resources:
+        return
+    xObject = resources['/XObject'].getObject()
+
     for obj in xObject:
         if xObject[obj]['/Subtype'] == '/Image':
-            filt = xObject[obj].get('/Filter', 'raw')
-            print("extracting {} {} to {}{:04}.xxx".format(obj, filt, filename_prefix, i))
-            size = (xObject[obj]['/Width'], xObject[obj]['/Height'])
-            color_space = xObject[obj]['/ColorSpace']
-            if isinstance(color_space, pdf.generic.ArrayObject) and color_space[0] == '/Indexed':
-                color_space, base, hival, lookup = [v.getObject() for v in color_space] # pg 262
-            if isinstance(color_space, pdf.generic.ArrayObject) and color_space[0] == '/ICCBased':
-                color_space, components = [v.getObject() for v in color_space] # pg 274
-            if color_space == '/ICCBased':
-                mode = {1: 'P', 3: 'RGB', '4': 'CMYK'}.get(components['/N'])
+            ref = xObject.raw_get(obj)
+            if isinstance(ref, pdf.generic.IndirectObject):
+                ref = (id(ref.pdf), ref.idnum, ref.generation)
             else:
-                mode = img_modes[color_space]
+                ref = None
+            jobs.append(ImageJob(xObject[obj], prefix + obj, page_number,
+                                 ref))
+    for obj in xObject:
+        form = xObject[obj]
+        if form['/Subtype'] == '/Form' and '/Resources' in form and \
+                id(form) not in forms:
+            forms.add(id(form))
+            _resource_image_jobs(form['/Resources'], page_number, jobs,
+                                 prefix + obj, forms)
 
-            # xObject[obj].getData() does not work for DCTDecode, JPXDecode and
-            # CCITTFaxDecode
-            if '/FlateDecode' in filt:
-                data = xObject[obj].getData()
-            else:
-                data = xObject[obj]._data  #   # for /FlateDecode only?
-
-            if data.endswith(b'~>'):
-                data = base64.a85decode(data, adobe=True)
-
-            if isinstance(filt, list):
-                while len(filt) > 1:
-                    first_filter = filt.pop(0)
-                    if first_filter == '/ASCII85Decode':
-                        continue
-                    else:
-                        print("Unsupported filter:", first_filter)
-                        return i
-                filt = filt[0]
-
-            if filt == '/FlateDecode':
-                img = Image.frombytes(mode, size, data)
-                fmt = 'jpg' if mode == 'CMYK' else 'png'
-                if color_space == '/Indexed':
-                    rawmode = img_modes[base]
-                    if rawmode == 'RGB':
-                        img.putpalette(lookup.getData(), rawmode)
-                        img = img.convert('RGB')
-                    else:  # Pillow's ImagePalette only supports RGB
-                        if rawmode in {'RGBA', 'CMYK'}:
-                            n = 4
-                        else:
-                            n = 3
-                        palette = lookup.getData()
-                        palette = [palette[i:i + n] for i in range(0, len(palette), n)]
-                        data2 = b''.join([palette[b] for b in data])
-                        img = Image.frombytes(rawmode, size, data2)
-                        fmt = 'jpg'
-
-                img_fname = "{}{:04}.{}".format(filename_prefix, i, fmt)
-                img.save(img_fname)
-            elif filt == '/DCTDecode':
-                img_fname = "{}{:04}.jpg".format(filename_prefix, i)
-                img = open(img_fname, "wb")
-                img.write(data)
-                img.close()
-            elif filt == '/JPXDecode':
-                img_fname = "{}{:04}.jp2".format(filename_prefix, i)
-                img = open(img_fname, "wb")
-                img.write(data)
-                img.close()
-#            The  CCITTFaxDecode filter decodes image data that has been encoded using
-#            either Group 3 or Group 4 CCITT facsimile (fax) encoding. CCITT encoding is
-#            designed to achieve efficient compression of monochrome (1 bit per pixel) image
-#            data at relatively low resolutions, and so is useful only for bitmap image data, not
-#            for color images, grayscale images, or general data.
+
+def image_count(page):
+    """Returns the number of images of a page, including those in its Form
+    XObjects, without reading them.
+    """
+    if '/Resources' not in page:
+        return 0
+    return _resource_image_count(page['/Resources'], set())
+
+
+def _resource_image_count(resources, forms):
+    resources = resources.getObject()
+    if '/XObject' not in resources:
+        return 0
+    xObject = resources['/XObject'].getObject()
+    count = 0
+    for obj in xObject:
+        subtype = xObject[obj].get('/Subtype')
+        if subtype == '/Image':
+            count += 1
+        elif subtype == '/Form' and '/Resources' in xObject[obj] and \
+                id(xObject[obj]) not in forms:
+            forms.add(id(xObject[obj]))
+            count += _resource_image_count(xObject[obj]['/Resources'], forms)
+    return count
+
+
+def write_image(job, filename_prefix="IMG_", i=0):
+    """Decodes the image of an `ImageJob` and writes it to
+    `filename_prefix` + `i`, with the extension matching its format.
+    Returns the written filename.
+    """
+    filt = job.filter
+    size = job.size
+    color_space = job.color_space
+    if color_space == '/ICCBased':
+        mode = {1: 'L', 3: 'RGB', 4: 'CMYK'}.get(job.icc_components)
+    elif color_space is None:  # Stencil mask (/ImageMask, pg 351)
+        mode = 'L'
+    else:
+        mode = img_modes[color_space]
+
+    if mode == 'L' and job.bits == 1:
+        mode = '1'
+    # Images in their own format (JPEG, JPEG 2000, fax) are written as they
+    # are, without decoding them, so the only decoding is of any filters
+    # that come before the format's
+    if job.decode_filters:
+        chunks = job.chunks()
+    else:
+        chunks = [job.data]
+
+    if filt == 'raw':
+        data = job.decoded()
+        if color_space == '/Indexed':
+            img = expand_palette(data, size, job.bits, img_modes[job.base],
+                                 job.lookup)
+        else:
+            img = Image.frombytes(mode, size, data)
+        fmt = 'jpg' if img.mode == 'CMYK' else 'png'
+
+        img_fname = "{}{:04}.{}".format(filename_prefix, i, fmt)
+        if job.icc_profile is not None:
+            img.save(img_fname, icc_profile=job.icc_profile)
+        else:
+            img.save(img_fname)
+    elif filt == '/DCTDecode':
+        img_fname = "{}{:04}.jpg".format(filename_prefix, i)
+        if job.icc_profile is not None:
+            chunks = jpeg_with_icc(chunks, job.icc_profile)
+        _write_chunks(img_fname, chunks)
+    elif filt == '/JPXDecode':
+        # JPEG 2000 files carry their own color specification
+        img_fname = "{}{:04}.jp2".format(filename_prefix, i)
+        _write_chunks(img_fname, chunks)
+#    The  CCITTFaxDecode filter decodes image data that has been encoded using
+#    either Group 3 or Group 4 CCITT facsimile (fax) encoding. CCITT encoding is
+#    designed to achieve efficient compression of monochrome (1 bit per pixel) image
+#    data at relatively low resolutions, and so is useful only for bitmap image data, not
+#    for color images, grayscale images, or general data.
 #
-#            K < 0 --- Pure two-dimensional encoding (Group 4)
-#            K = 0 --- Pure one-dimensional encoding (Group 3, 1-D)
-#            K > 0 --- Mixed one- and two-dimensional encoding (Group 3, 2-D)
-            elif filt == '/CCITTFaxDecode':
-                if xObject[obj]['/DecodeParms']['/K'] == -1:
-                    CCITT_group = 4
-                else:
-                    CCITT_group = 3
-                width = xObject[obj]['/Width']
-                height = xObject[obj]['/Height']
-
-                img_size = len(data)
-                tiff_header = tiff_header_for_CCITT(width, height, img_size, CCITT_group)
-                img_fname = "{}{:04}.tiff".format(filename_prefix, i)
-                with open(img_fname, 'wb') as img_file:
-                    img_file.write(tiff_header + data)
-            elif filt == 'raw':
-                img = Image.frombytes('CMYK', size, data)
-                img_fname = "{}{:04}.jpg".format(filename_prefix, i)
-                img.save(img_fname)
-
-            # Try to insert ICC profile
-            if color_space == '/ICCBased':
-                img = Image.open(img_fname)
-                img.save(img_fname, icc_profile=components.getData())
-
-            # Grabbing image mask and applying it to another image
-            # TODO: support the /Mask property (pg 341, 351)
-            #       wish I had a test file
-            if '/SMask' in xObject[obj]:  # Soft mask (pg 341)
-                # Simplified image loading. Masks should only be black & white
-                # or grayscale
-                msize = (xObject[obj]['/SMask']['/Width'],
-                         xObject[obj]['/SMask']['/Height'])
-                mcolor_space = xObject[obj]['/SMask']['/ColorSpace']
-                mmode = img_modes[mcolor_space]
-                mdata = data = xObject[obj]['/SMask'].getData()
-                mask = Image.frombytes(mmode, msize, mdata)
-
-                img = Image.open(img_fname)
-                if img.mode not in {'RGB', 'RGBA'}:
-                    img = img.convert('RGBA')
-
-                img.putalpha(mask)
-                img.save("{}{:04}_masked.png".format(filename_prefix, i))
+#    K < 0 --- Pure two-dimensional encoding (Group 4)
+#    K = 0 --- Pure one-dimensional encoding (Group 3, 1-D)
+#    K > 0 --- Mixed one- and two-dimensional encoding (Group 3, 2-D)
+    elif filt == '/CCITTFaxDecode':
+        if job.filter_parms.get('/K', 0) < 0:
+            CCITT_group = 4
+        else:
+            CCITT_group = 3
+        width, height = size
 
-            i += 1
+        data = job.decoded()
+        img_size = len(data)
+        tiff_header = tiff_header_for_CCITT(width, height, img_size, CCITT_group)
+        img_fname = "{}{:04}.tiff".format(filename_prefix, i)
+        _write_chunks(img_fname, [tiff_header, data])
+
+    # Grabbing image mask and applying it to another image
+    # TODO: support the /Mask property (pg 341, 351)
+    #       wish I had a test file
+    if job.smask is not None:  # Soft mask (pg 341)
+        # Simplified image loading. Masks should only be black & white
+        # or grayscale
+        msize = job.smask.size
+        mmode = img_modes[job.smask.color_space]
+        mdata = job.smask.decoded()
+        mask = Image.frombytes(mmode, msize, mdata)
+
+        img = Image.open(img_fname)
+        if img.mode not in {'RGB', 'RGBA'}:
+            img = img.convert('RGBA')
 
+        img.putalpha(mask)
+        img.save("{}{:04}_masked.png".format(filename_prefix, i))
+
+    return img_fname
+
+
+def _decode_image(job, filename_prefix, i):
+    """Runs `write_image`, recording its time and the image's filters."""
+    with profiling.span('decode'):
+        filename = write_image(job, filename_prefix, i)
+    profiling.count('images_decoded:' + (" ".join(job.filters) or 'raw'))
+    return filename
+
+
+def extract_images(page, filename_prefix="IMG_", start_index=0):
+    i = start_index
+    for job in image_jobs(page):
+        if job.filter is None:
+            continue
+        _decode_image(job, filename_prefix, i)
+        i += 1
     return i
 
 
-def image_to_pdf(image_filename, page_size_cm):
+def _write_image_job(job, filename_prefix, i):
+    try:
+        return _decode_image(job, filename_prefix, i), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _numbered_jobs(pages, start_index, failed_pages, occurrences, dedup):
+    """Yields the jobs to run and their indexes. Every image found is
+    appended to `occurrences` as (page number, XObject name, index); with
+    `dedup`, images already seen (same indirect object or same content) are
+    not yielded again, and their occurrences point to the first index.
+    """
+    seen_refs = {}
+    seen_digests = {}
+    i = start_index
+    for page_number, page in enumerate(pages):
+        try:
+            page_jobs = image_jobs(page, page_number)
+        except Exception:
+            traceback.print_exc()
+            failed_pages.append(page_number)
+            continue
+        for job in page_jobs:
+            if job.filter is None:
+                print("page {}: unsupported filter chain {} for {}".format(
+                    page_number + 1, " ".join(job.filters), job.name),
+                    file=sys.stderr)
+                if page_number not in failed_pages:
+                    failed_pages.append(page_number)
+                continue
+            if dedup:
+                index = seen_refs.get(job.ref)
+                if index is None:
+                    index = seen_digests.setdefault(job.digest(), i)
+                    if job.ref:
+                        seen_refs[job.ref] = index
+                if index != i:
+                    occurrences.append((page_number, job.name, index))
+                    continue
+            occurrences.append((page_number, job.name, i))
+            yield job, i
+            i += 1
+
+
+def write_manifest(filename, rows):
+    """Writes the manifest mapping each page's XObjects to the extracted
+    files, as CSV if `filename` ends with .csv or JSON otherwise.
+    """
+    fields = ['page', 'xobject', 'index', 'file', 'duplicate']
+    if filename.lower().endswith('.csv'):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(filename, 'w') as f:
+            json.dump(rows, f, indent=1)
+
+
+def pool_context():
+    """Returns the multiprocessing context for a pool of workers that only
+    need their arguments: the default one, unless other threads are running
+    (e.g. the GUI's), as forking then may copy locks held by them; the
+    workers are spawned instead.
+    """
+    if threading.active_count() == 1:
+        return None
+    return multiprocessing.get_context('spawn')
+
+
+def extract_images_parallel(pages, filename_prefix="IMG_", start_index=0,
+                            processes=None, dedup=False, manifest=None,
+                            progress=None):
+    """Extracts the images of all `pages`, decoding and writing them in a
+    pool of `processes` (default: number of CPUs). `pages` is a sequence of
+    page objects, only iterated once, so it may render them as they're
+    needed (see pdf_pages.RenderedPages).
+
+    Indexes are assigned in page order before the images are dispatched, so
+    the files are named exactly as in a serial run of `extract_images`.
+    With `dedup`, each distinct image is only decoded and written once.
+    If `manifest` is given, a manifest of the extracted files is written
+    to it (see `write_manifest`).
+    `progress(pages done, total pages)` is called as images are written; if
+    it raises, the images not dispatched yet are skipped.
+    Returns the next free index and the numbers (0-based) of the pages
+    whose images couldn't all be extracted.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    failed_pages = []
+    occurrences = []
+    filenames = {}
+    next_index = start_index
+    jobs = _numbered_jobs(pages, start_index, failed_pages, occurrences,
+                          dedup)
+
+    def done(job, i, result):
+        filenames[i], error = result
+        if error is not None:
+            print(error, file=sys.stderr)
+            if job.page_number not in failed_pages:
+                failed_pages.append(job.page_number)
+        if progress is not None:
+            progress(job.page_number + 1, len(pages))
+
+    if processes == 1:
+        for job, i in jobs:
+            done(job, i, _write_image_job(job, filename_prefix, i))
+            next_index = i + 1
+    else:
+        # Keep a bounded number of images in flight, so that the raw data of
+        # every image isn't loaded at once
+        executor = futures.ProcessPoolExecutor(processes,
+                                               mp_context=pool_context())
+        try:
+            pending = collections.deque()
+            for job, i in jobs:
+                pending.append((job, i, executor.submit(
+                    profiling.call_recorded, _write_image_job, job,
+                    filename_prefix, i)))
+                next_index = i + 1
+                if len(pending) >= 4 * processes:
+                    job, i, future = pending.popleft()
+                    result, recorded = future.result()
+                    profiling.merge(recorded)
+                    done(job, i, result)
+            for job, i, future in pending:
+                result, recorded = future.result()
+                profiling.merge(recorded)
+                done(job, i, result)
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+        executor.shutdown()
+
+    if manifest:
+        first_seen = set()
+        rows = []
+        for page_number, name, i in occurrences:
+            rows.append({'page': page_number + 1, 'xobject': name,
+                         'index': i, 'file': filenames.get(i),
+                         'duplicate': i in first_seen})
+            first_seen.add(i)
+        write_manifest(manifest, rows)
+    return next_index, sorted(failed_pages)
+
+
+# Color spaces of JPEG images embedded as they are, by PIL mode
+jpeg_color_spaces = {'L': '/DeviceGray', 'RGB': '/DeviceRGB',
+                     'CMYK': '/DeviceCMYK'}
+
+
+# Bytes with their bits reversed, for TIFF data stored least significant
+# bit first (FillOrder 2)
+_reversed_bits = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def image_page_sizes(image_filename, dpi=72.):
+    """Returns the sizes (cm) of the pages showing an image at `dpi`: one
+    per frame for TIFF files, which may have several pages, or else one.
+    Only the headers are read.
+    """
+    sizes = []
+    with Image.open(image_filename) as img:
+        frames = img.n_frames if img.format == 'TIFF' else 1
+        for frame in range(frames):
+            img.seek(frame)
+            width, height = img.size
+            sizes.append((width/dpi*2.54, height/dpi*2.54))
+    return sizes
+
+
+def _ccitt_strip(img):
+    """Returns the image description and data of a TIFF frame compressed
+    as a single CCITT Group 4 strip, which PDF can show as it is
+    (/CCITTFaxDecode, pg 82), or None if it isn't one. Strips are encoded
+    independently, so several can't be joined into one stream.
+    """
+    tags = img.tag_v2
+    offsets = tags.get(273)  # StripOffsets
+    if tags.get(259) != 4 or offsets is None or len(offsets) != 1:
+        return None
+    width, height = img.size
+    image = ("/Filter /CCITTFaxDecode /DecodeParms << /K -1 /Columns {} "
+             "/Rows {} >> /BitsPerComponent 1 /ColorSpace /DeviceGray"
+             .format(width, height))
+    if tags.get(262, 0) == 1:  # BlackIsZero: the coded "white" is black
+        image += " /Decode [1 0]"
+    img.fp.seek(offsets[0])
+    data = img.fp.read(tags[279][0])  # StripByteCounts
+    if tags.get(266, 1) == 2:  # FillOrder
+        data = data.translate(_reversed_bits)
+    return image, data
+
+
+def embedded_image_pdf(image_filename, page_size_cm, frame=0):
+    """Returns a one page PDF showing a JPEG or JPEG 2000 image, or a frame
+    of a TIFF file compressed with CCITT Group 4, with the image data
+    embedded as it is (/DCTDecode, /JPXDecode or /CCITTFaxDecode, pg 340)
+    instead of being decoded and compressed again. Only the headers are
+    read to describe the image. Returns None for other formats.
+    """
+    data = None
+    with Image.open(image_filename) as img:
+        img.seek(frame)
+        width, height = img.size
+        if img.format == 'JPEG' and img.mode in jpeg_color_spaces:
+            image = ("/Filter /DCTDecode /BitsPerComponent 8 "
+                     "/ColorSpace {}".format(jpeg_color_spaces[img.mode]))
+            if img.mode == 'CMYK' and 'adobe' in img.info:
+                # Adobe's CMYK JPEGs are stored inverted
+                image += " /Decode [1 0 1 0 1 0 1 0]"
+        elif img.format == 'JPEG2000':
+            # The color space and depth come from the JPEG 2000 data
+            image = "/Filter /JPXDecode"
+        elif img.format == 'TIFF':
+            strip = _ccitt_strip(img)
+            if strip is None:
+                return None
+            image, data = strip
+        else:
+            return None
+    if data is None:
+        with open(image_filename, 'rb') as f:
+            data = f.read()
+
+    size_pdf = [s/2.54*72 for s in page_size_cm] # cm->in->1/72" (PDF unit)
+    content = "q {0:.4f} 0 0 {1:.4f} 0 0 cm /Im0 Do Q".format(*size_pdf)
+    objects = [
+        ["<< /Type /Catalog /Pages 2 0 R >>"],
+        ["<< /Type /Pages /Kids [3 0 R] /Count 1 >>"],
+        ["<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {0:.4f} {1:.4f}] "
+         "/Resources << /XObject << /Im0 4 0 R >> >> "
+         "/Contents 5 0 R >>".format(*size_pdf)],
+        ["<< /Type /XObject /Subtype /Image /Width {} /Height {} {} "
+         "/Length {} >>\nstream\n".format(width, height, image, len(data)),
+         data, "\nendstream"],
+        ["<< /Length {} >>\nstream\n{}\nendstream".format(len(content),
+                                                          content)],
+    ]
+    tmp = BytesIO()
+    tmp.write(b"%PDF-1.5\n%\xE2\xE3\xCF\xD3\n")
+    offsets = []
+    for number, parts in enumerate(objects, 1):
+        offsets.append(tmp.tell())
+        tmp.write("{} 0 obj\n".format(number).encode('ascii'))
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = part.encode('ascii')
+            tmp.write(part)
+        tmp.write(b"\nendobj\n")
+    xref = tmp.tell()
+    tmp.write("xref\n0 {}\n0000000000 65535 f \n".format(
+        len(objects) + 1).encode('ascii'))
+    for offset in offsets:
+        tmp.write("{:010} 00000 n \n".format(offset).encode('ascii'))
+    tmp.write("trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n"
+              .format(len(objects) + 1, xref).encode('ascii'))
+    tmp.seek(0)
+    return tmp
+
+
+def image_to_pdf(image_filename, page_size_cm, frame=0):
+    """Returns a one page PDF showing an image, or the `frame`-th frame of a
+    multi-page image.
+    """
+    tmp = embedded_image_pdf(image_filename, page_size_cm, frame)
+    if tmp is not None:
+        return tmp
     tmp = BytesIO()
-    image_reader = ImageReader(image_filename)
     size_pdf = [s/2.54*72 for s in page_size_cm] # cm->in->1/72" (PDF unit)
-    output_pdf = canvas.Canvas(tmp, pagesize=size_pdf)
-    output_pdf.drawImage(image_reader, 0, 0, *size_pdf, mask='auto')
-    output_pdf.showPage()
-    output_pdf.save()
+    with Image.open(image_filename) as img:
+        if frame:
+            img.seek(frame)
+            image_reader = ImageReader(img)
+        else:
+            image_reader = ImageReader(image_filename)
+        output_pdf = canvas.Canvas(tmp, pagesize=size_pdf)
+        output_pdf.drawImage(image_reader, 0, 0, *size_pdf, mask='auto')
+        output_pdf.showPage()
+        output_pdf.save()
     tmp.seek(0)
     return tmp
+
+
+def convert_image(image_filename, dpi=72.):
+    """Converts an image file to a one page PDF sized according to `dpi`,
+    e.g. in a worker process. Returns the page size (cm) and the PDF data.
+    """
+    page_size_cm = image_page_sizes(image_filename, dpi)[0]
+    return page_size_cm, image_to_pdf(image_filename, page_size_cm).getvalue()
@@ -0,0 +1,741 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Pages and the page pipeline (loading, writing), kept free of any Qt imports
+so they can be used headless.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import os
+import os.path as osp
+import uuid
+import shutil
+import threading
+import multiprocessing
+from concurrent import futures
+
+from PyPDF2.pdf import PageObject, ContentStream
+from PyPDF2.generic import (ArrayObject, DictionaryObject, NameObject,
+                            DecodedStreamObject, EncodedStreamObject)
+
+import pdf_images
+import pdf_sources
+import pdf_writer
+import profiling
+import session
+
+
+image_exts = ['.jpg', '.jpeg', '.bmp', '.gif', '.j2p', '.jp2', '.jpx', '.png',
+              '.tif', '.tiff']
+# Images that may have several pages, loaded frame by frame
+multi_page_exts = ['.tif', '.tiff']
+
+
+class Page(object):
+    """A page of a source document and the operations applied to it.
+
+    Operations are only recorded, as ('rotate', degrees clockwise) or
+    (op, page, tx, ty) for merges, stamps and backgrounds, and run when the
+    page object is needed (see `obj`).
+    """
+    def __init__(self, source=None, page_number=0):
+        self.source = source
+        self.page_number = page_number
+        # Documents this page reads from, including merged pages' documents
+        self.sources = []
+        if source is not None:
+            self.hold(source)
+        self.uuid = uuid.uuid4()
+        self.ops = []
+        self._obj = None
+        self._form = None
+        self._snapshot = None
+        self.transforms = ""
+        self._numbers = []
+        self._basename = "Invalid Page"
+
+    def __del__(self):
+        for source in self.sources:
+            source.release()
+
+    def hold(self, source):
+        source.acquire()
+        self.sources.append(source)
+
+    @property
+    def obj(self):
+        """The page object, rendered from the source document and the page's
+        operations when it is first needed (e.g. written), and again after
+        any new operation.
+        """
+        if self._obj is None:
+            with profiling.span('render'):
+                self._obj = render(self.source.copy_page(self.page_number),
+                                   self.ops)
+        return self._obj
+
+    def rendered(self):
+        """The page object, as `obj`, but not cached if it wasn't already,
+        so that writing many pages doesn't keep them all in memory.
+        """
+        if self._obj is not None:
+            return self._obj
+        with profiling.span('render'):
+            return render(self.source.copy_page(self.page_number), self.ops)
+
+    def forget(self):
+        """Lets the page's documents drop the objects read for it, once it
+        was written.
+        """
+        for source in self.sources:
+            source.forget()
+
+    def form(self):
+        """The page as a Form XObject (see `form_xobject`), made once and
+        shared by all the pages it's stamped on or put behind.
+        """
+        if self._form is None:
+            self._form = form_xobject(self.obj)
+        return self._form
+
+    def _add_op(self, op):
+        self.ops.append(op)
+        self._obj = None
+        self._form = None
+        self._snapshot = None
+
+    def snapshot(self):
+        """Returns a copy of the page, unaffected by its later operations.
+        The same copy is returned until the page changes, so a page stamped
+        on many others is only rendered once.
+        """
+        if self._snapshot is None:
+            page = Page(self.source, self.page_number)
+            for source in self.sources[1:]:
+                page.hold(source)
+            page.ops = list(self.ops)
+            page._obj = self._obj
+            page._form = self._form
+            page.uuid = self.uuid
+            page.transforms = self.transforms
+            page._numbers = list(self._numbers)
+            page._basename = self._basename
+            self._snapshot = page
+        return self._snapshot
+
+    @classmethod
+    def from_source(cls, source, page_number):
+        """The page `page_number` of a source document, which is only read
+        when the page is needed.
+        """
+        page = Page(source, page_number)
+        page._numbers = [str(page_number + 1)]
+        page._basename = source.name
+        return page
+
+    @classmethod
+    def from_file(cls, filename):
+        pages = []
+        with profiling.span('load'):
+            source = pdf_sources.cache.open(filename)
+            total_pages = source.getNumPages()
+            for page_number in range(total_pages):
+                pages.append(cls.from_source(source, page_number))
+            source.release()
+        profiling.count('pages_loaded', total_pages)
+        return pages
+
+    @classmethod
+    def from_image(cls, filename, page_size_cm, data=None, frame=None,
+                   lazy=False):
+        """`frame` is the frame shown by the page, for multi-page images.
+        With `lazy`, the image is converted when the page is first read.
+        """
+        source = pdf_sources.cache.open_image(filename, page_size_cm, data,
+                                              frame, lazy)
+        page = Page(source)
+        source.release()
+        page._basename = source.name
+        page._numbers = ["I"] if frame is None else [str(frame + 1)]
+        profiling.count('pages_loaded')
+        return page
+
+    def rotateLeft(self):
+        self._add_op(('rotate', -90))
+        self.transforms += '↺'
+        if self.transforms.endswith('↻↺'):
+            self.transforms = self.transforms[:-2]
+        if self.transforms.endswith('↺↺↺'):
+            self.transforms = self.transforms[:-3]+'↻'
+
+    def rotateRight(self):
+        self._add_op(('rotate', 90))
+        self.transforms += '↻'
+        if self.transforms.endswith('↺↻'):
+            self.transforms = self.transforms[:-2]
+        if self.transforms.endswith('↻↻↻'):
+            self.transforms = self.transforms[:-3]+'↺'
+
+    def merge(self, page, tx=0.0, ty=0.0, op="merge"):
+        """op in ['merge', 'stamp', 'background']"""
+        assert(op in ["merge", "stamp", "background"])
+        self._add_op((op, page.snapshot(), tx, ty))
+        for source in page.sources:
+            self.hold(source)
+        # Adjust name
+        if op == "merge":
+            if self._basename == page._basename:
+                self._numbers.append(','.join(page._numbers))
+            else:
+                self._numbers.append(u"{0}<{1}>".format(page._basename,
+                                     ','.join(page._numbers)))
+            self.transforms += "M"
+        elif op == "stamp":
+            self.transforms += "⊙"
+        elif op == "background":
+            self.uuid = page.uuid
+            self._numbers = page._numbers
+            self.transforms = page.transforms + "▣"
+            self._basename = page._basename
+
+    @property
+    def name(self):
+        return u"{0}<{1}>[{2}]".format(self._basename,
+                                       ','.join(self._numbers),
+                                       self.transforms)
+
+
+# Resources merged when pages are superposed, as by PyPDF2's mergePage
+_resource_types = ["/ExtGState", "/Font", "/XObject", "/ColorSpace",
+                   "/Pattern", "/Shading", "/Properties"]
+
+
+def plan(ops):
+    """Optimizes a page's operations into the steps that render it.
+
+    Rotations are summed into a single one. They only set the page's
+    /Rotate, which merges and stamps don't depend on, so they can move past
+    them, but not past backgrounds, which draw the rotated page. Consecutive
+    merges and stamps are drawn together, as ('overlay', [(op, page, tx,
+    ty), ...]).
+    """
+    steps = []
+    rotation = 0
+    overlays = []
+    for op in ops + [('end',)]:
+        if op[0] == 'rotate':
+            rotation += op[1]
+        elif op[0] in ('merge', 'stamp'):
+            overlays.append(op)
+        else:
+            if overlays:
+                steps.append(('overlay', overlays))
+                overlays = []
+            if rotation % 360:
+                steps.append(('rotate', rotation % 360))
+            rotation = 0
+            if op[0] == 'background':
+                steps.append(op)
+    return steps
+
+
+def render(obj, ops):
+    """Runs a page's operations on its page object `obj`, returning the
+    resulting page object. Stamps and backgrounds are drawn from their
+    page's Form XObject, while merged pages' contents are added to the page.
+    """
+    for step in plan(ops):
+        if step[0] == 'rotate':
+            obj.rotateClockwise(step[1])
+        elif step[0] == 'overlay':
+            overlays = [(page.obj, tx, ty,
+                         page.form() if op == 'stamp' else None)
+                        for op, page, tx, ty in step[1]]
+            with profiling.span('merge'):
+                overlay_pages(obj, overlays)
+        else:  # Background: the page goes over the background, on a blank
+            page, tx, ty = step[1:]
+            overlays = [(page.obj, tx, ty, page.form())]
+            with profiling.span('merge'):
+                page0 = PageObject.createBlankPage(obj.pdf,
+                    obj.mediaBox.getWidth(), obj.mediaBox.getHeight())
+                overlay_pages(page0, overlays + [(obj, 0, 0, None)])
+            obj = page0
+    return obj
+
+
+def overlay_matrix(page1, page2, tx, ty):
+    """Returns the transformation matrix drawing `page2` upright over
+    `page1`, with its lower left corner at (tx, ty), in page1 coordinates
+    (x = right; y = up).
+    """
+    rotation = int(page2.get("/Rotate") or 0) % 360  # Clockwise
+    tx, ty = float(tx), float(ty)
+    height1 = float(page1.mediaBox.getHeight())
+    width2 = float(page2.mediaBox.getWidth())
+    height2 = float(page2.mediaBox.getHeight())
+    if rotation == 90:
+        ty += height1
+    elif rotation == 180:
+        tx += width2
+        ty += height1
+    elif rotation == 270:
+        tx += height2
+        ty += height1 - width2
+    # Cosine and sine of the counterclockwise rotation undoing /Rotate
+    cos, sin = {0: (1, 0), 90: (0, -1), 180: (-1, 0), 270: (0, 1)}[rotation]
+    return (cos, sin, -sin, cos, tx, ty)
+
+
+def _number(value):
+    text = "{:.6f}".format(value).rstrip('0').rstrip('.')
+    return '0' if text in ('', '-0') else text
+
+
+def _content_stream(data):
+    stream = DecodedStreamObject()
+    stream.setData(data)
+    return stream
+
+
+def _content_streams(page):
+    """The page's content streams, as they are referenced by the page."""
+    if '/Contents' not in page:
+        return []
+    contents = page.raw_get('/Contents')
+    if isinstance(contents.getObject(), ArrayObject):
+        return list(contents.getObject())
+    return [contents]
+
+
+def form_xobject(page):
+    """Returns a Form XObject (pg 355) drawing a page object, with the page's
+    resources. A single content stream is used as it is, still encoded.
+    """
+    contents = [ref.getObject() for ref in _content_streams(page)]
+    if len(contents) == 1 and isinstance(contents[0], EncodedStreamObject):
+        form = EncodedStreamObject()
+        form._data = contents[0]._data
+        for key in ('/Filter', '/DecodeParms'):
+            if key in contents[0]:
+                form[NameObject(key)] = contents[0].raw_get(key)
+    else:
+        form = _content_stream(b"\n".join(stream.getData()
+                                          for stream in contents))
+        form = form.flateEncode()
+    form[NameObject('/Type')] = NameObject('/XObject')
+    form[NameObject('/Subtype')] = NameObject('/Form')
+    form[NameObject('/BBox')] = ArrayObject(page.mediaBox)
+    if '/Resources' in page:
+        form[NameObject('/Resources')] = page.raw_get('/Resources')
+    return form
+
+
+def overlay_pages(page1, overlays):
+    """Draws pages over `page1`, in order, given as (page, tx, ty, form) and
+    placed as by `overlay_matrix`.
+
+    Pages with a `form` (see `form_xobject`) are drawn by referencing it,
+    so the page's content and resources are shared by all the pages it's
+    drawn on. Other pages' contents are added to page1: page1's content is
+    wrapped once for all of them, and the content streams are only
+    referenced from the new /Contents array, so they aren't parsed and
+    serialized again, unless an overlay's resource names had to be renamed.
+    """
+    resources = page1.get('/Resources', DictionaryObject()).getObject()
+    annots = ArrayObject()
+    if isinstance(page1.get('/Annots'), ArrayObject):
+        annots.extend(page1['/Annots'])
+    streams = _content_streams(page1)
+    if streams:
+        streams = ([_content_stream(b"q\n")] + streams +
+                   [_content_stream(b"\nQ\n")])
+    for page2, tx, ty, form in overlays:
+        matrix = " ".join(_number(value)
+                          for value in overlay_matrix(page1, page2, tx, ty))
+        if isinstance(page2.get('/Annots'), ArrayObject):
+            annots.extend(page2['/Annots'])
+        if form is not None:
+            resources = DictionaryObject(resources)
+            xobjects = DictionaryObject(
+                resources.get('/XObject', DictionaryObject()).getObject())
+            i = 0
+            while NameObject('/Overlay{}'.format(i)) in xobjects:
+                i += 1
+            name = NameObject('/Overlay{}'.format(i))
+            xobjects[name] = form
+            resources[NameObject('/XObject')] = xobjects
+            streams.append(_content_stream("q\n{} cm\n{} Do\nQ\n".format(
+                matrix, name).encode('ascii')))
+            continue
+
+        page2_resources = page2.get('/Resources',
+                                    DictionaryObject()).getObject()
+        new_resources = DictionaryObject()
+        rename = {}
+        for res in _resource_types:
+            new, new_rename = PageObject._mergeResources(
+                resources, page2_resources, res)
+            if new:
+                new_resources[NameObject(res)] = new
+                rename.update(new_rename)
+        new_resources[NameObject("/ProcSet")] = ArrayObject(
+            frozenset(resources.get("/ProcSet", ArrayObject()).getObject())
+            .union(frozenset(page2_resources.get("/ProcSet",
+                                                 ArrayObject()).getObject())))
+        resources = new_resources
+
+        contents = _content_streams(page2)
+        if not contents:
+            continue
+        if rename:
+            contents = [PageObject._contentStreamRename(
+                ContentStream(ArrayObject(contents), page2.pdf), rename,
+                page2.pdf)]
+        streams.append(_content_stream("q\n{} cm\n".format(matrix)
+                                       .encode('ascii')))
+        streams.extend(contents)
+        streams.append(_content_stream(b"\nQ\n"))
+    page1[NameObject('/Contents')] = ArrayObject(streams)
+    page1[NameObject('/Resources')] = resources
+    page1[NameObject('/Annots')] = annots
+
+
+def is_image(filename):
+    return osp.splitext(filename.lower())[1] in image_exts
+
+
+def load_pages(filename, dpi=72.):
+    """Loads all pages from a PDF or the single page of an image, sized
+    according to `dpi`.
+    """
+    pages = []
+    basefile, ext = osp.splitext(filename.lower())
+    if ext == '.pdf':
+        pages = Page.from_file(filename)
+    elif ext in image_exts:
+        sizes = pdf_images.image_page_sizes(filename, dpi)
+        if len(sizes) == 1:
+            pages.append(Page.from_image(filename, sizes[0]))
+        else:
+            for frame, img_size in enumerate(sizes):
+                pages.append(Page.from_image(filename, img_size,
+                                             frame=frame))
+    return pages
+
+
+def load_files(filenames, dpi=72., threads=None, processes=None):
+    """Loads several files concurrently, in a pool of `threads` (default:
+    ThreadPoolExecutor's), so that their parsing overlaps with reading.
+    When there are several images, they're converted to PDF in a pool of
+    `processes` (default: number of CPUs) instead, as converting them is
+    mostly CPU bound. Multi-page images are always loaded in the threads,
+    as their frames are only converted when they're first read.
+
+    Yields (index in `filenames`, pages, exception) in the order the files
+    finish loading, with the exception set if the file couldn't be loaded.
+    Files not started yet are skipped if the generator is closed early.
+    """
+    def load(filename):
+        return load_pages(filename, dpi)
+
+    processes = processes or multiprocessing.cpu_count()
+    images = [i for i, filename in enumerate(filenames)
+              if is_image(filename) and
+              osp.splitext(filename.lower())[1] not in multi_page_exts]
+    if processes == 1 or len(images) < 2:
+        images = []
+    executor = futures.ThreadPoolExecutor(threads)
+    image_executor = (futures.ProcessPoolExecutor(
+        processes, mp_context=pdf_images.pool_context()) if images else None)
+    try:
+        indexes = {}
+        for i in images:
+            indexes[image_executor.submit(pdf_images.convert_image,
+                                          filenames[i], dpi)] = i
+        images = set(images)
+        for i, filename in enumerate(filenames):
+            if i not in images:
+                indexes[executor.submit(load, filename)] = i
+        for future in futures.as_completed(indexes):
+            i = indexes[future]
+            try:
+                if i in images:
+                    page_size_cm, data = future.result()
+                    pages = [Page.from_image(filenames[i], page_size_cm,
+                                             data)]
+                else:
+                    pages = future.result()
+            except Exception as e:
+                yield i, [], e
+            else:
+                yield i, pages, None
+    finally:
+        executor.shutdown(cancel_futures=True)
+        if image_executor is not None:
+            image_executor.shutdown(cancel_futures=True)
+
+
+class RenderedPages(object):
+    """The objects of `pages`, rendered as they're iterated rather than all
+    at once (see `Page.rendered`), e.g. for extracting their images. The
+    objects read for a page are dropped once the next one is reached.
+    """
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __iter__(self):
+        for page in self.pages:
+            yield page.rendered()
+            page.forget()
+
+
+def write_pages(pages, stream, progress=None):
+    """Writes pages to a PDF stream, as they are serialized, rendering and
+    reading each page only while it's written.
+    `progress(done, total)` is called after each page.
+    """
+    writer = pdf_writer.StreamingPdfWriter(stream)
+    for i, page in enumerate(pages):
+        obj = page.rendered()
+        with profiling.span('write'):
+            writer.add_page(obj)
+        page.forget()
+        if progress is not None:
+            progress(i + 1, len(pages))
+    with profiling.span('write'):
+        writer.close()
+    profiling.count('pages_written', len(pages))
+    profiling.count('bytes_written', writer.stream.offset)
+
+
+def write_incremental(pages, filename, progress=None):
+    """Writes pages loaded from a single PDF document as the document's file
+    followed by an incremental update (pg 109), which holds only the pages
+    that changed, and a new page tree if they were reordered. The file's
+    bytes are left as they are: if `filename` is the document's file, the
+    update is appended to it, and otherwise the file is copied first.
+
+    Returns False, without writing anything, if the pages don't all come
+    from the same document, if its file can't take an update (see
+    SourceDocument.revision), or if less than half of its pages are kept,
+    as the others would still take space in the output. Otherwise returns
+    True. If writing fails (or `progress` raises, to cancel it), the output
+    is left as it was.
+    """
+    if not pages:
+        return False
+    source = pages[0].source
+    if any(page.source is not source for page in pages):
+        return False
+    revision = source.revision()
+    if revision is None:
+        return False
+    reader = source.reader
+    pages_ref = reader.trailer['/Root'].getObject().raw_get('/Pages')
+    numbers = [page.page_number for page in pages]
+    total = source.getNumPages()
+    if len(set(numbers)) * 2 < total or pages_ref.generation != 0:
+        return False
+    keep_tree = (numbers == list(range(total)) and
+                 pages_ref.idnum not in source.revised)
+    refs = [source.copy_page(number).indirectRef for number in numbers]
+    changed = not keep_tree or any(page.ops or ref.idnum in source.revised
+                                   for page, ref in zip(pages, refs))
+    in_place = (osp.exists(filename) and
+                osp.samefile(filename, source.filename))
+    if in_place and not changed:
+        return True
+
+    target = filename if in_place else filename + '.tmp'
+    prev, size = revision
+    try:
+        if not in_place:
+            shutil.copyfile(source.filename, target)
+        if not changed:
+            pdf_sources.cache.release_file(filename)
+            os.replace(target, filename)
+            return True
+        with open(target, 'r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            try:
+                f.seek(end - 1)
+                if f.read(1) not in (b'\n', b'\r'):
+                    f.write(b'\n')
+                writer = pdf_writer.IncrementalPdfWriter(
+                    f, reader, f.tell(), prev, size, keep_tree)
+                for i, (page, ref) in enumerate(zip(pages, refs)):
+                    if page.ops or ref.idnum in source.revised or \
+                            not writer.keep_page(ref):
+                        obj = page.rendered()
+                        with profiling.span('write'):
+                            writer.add_page(obj, ref)
+                        page.forget()
+                    if progress is not None:
+                        progress(i + 1, len(pages))
+                with profiling.span('write'):
+                    writer.close()
+            except BaseException:
+                if in_place:
+                    f.truncate(end)
+                raise
+    except BaseException:
+        if not in_place and osp.exists(target):
+            os.remove(target)
+        raise
+    if in_place:
+        source.appended(writer.xref_location, writer.size, writer.replaced)
+    else:
+        pdf_sources.cache.release_file(filename)
+        os.replace(target, filename)
+    profiling.count('pages_written', len(writer.replaced))
+    profiling.count('bytes_written', writer.stream.offset - end)
+    return True
+
+
+def write_single(pages, filename, progress=None, incremental=False):
+    """Writes all pages to a single PDF file.
+
+    With `incremental`, the pages are written as an incremental update of
+    the document they were loaded from, if they can be (see
+    `write_incremental`).
+
+    Otherwise, the file is written through a temporary file, since the
+    pages being written may still be reading from the file being replaced.
+    Documents still reading from it are then read into memory, as open
+    files can't be replaced on Windows. If writing fails (or `progress`
+    raises, to cancel it), the output is left as is.
+    """
+    if incremental and write_incremental(pages, filename, progress):
+        return
+    tmp_filename = filename + '.tmp'
+    try:
+        with open(tmp_filename, 'wb') as f:
+            write_pages(pages, f, progress)
+    except BaseException:
+        if osp.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    pdf_sources.cache.release_file(filename)
+    os.replace(tmp_filename, filename)
+
+
+def split_filenames(fileprefix, count):
+    return ["{}{:04}.pdf".format(fileprefix, i) for i in range(count)]
+
+
+# Pages being split, inherited by the forked worker processes, or
+# recreated by the spawned ones
+_split_pages = []
+_split_groups = []
+_split_filenames = []
+
+
+def _reopen_split_sources():
+    reopened = set()
+    for page in _split_pages:
+        for source in page.sources:
+            if id(source) not in reopened:
+                source.reopen()
+                reopened.add(id(source))
+
+
+def _restore_split_pages(description, groups, filenames):
+    global _split_pages, _split_groups, _split_filenames
+    _split_pages = session.restore(description)
+    _split_groups, _split_filenames = groups, filenames
+
+
+def _write_split_pages(indexes):
+    for i in indexes:
+        with open(_split_filenames[i], 'wb') as f:
+            write_pages([_split_pages[j] for j in _split_groups[i]], f)
+    return len(indexes)
+
+
+def write_multi(pages, fileprefix, processes=None, progress=None,
+                groups=None):
+    """Writes each page to its own PDF file, named after `fileprefix` and the
+    file index. Nothing is written if any of the files already exists.
+    `groups` are lists of page indexes written to the same file instead, in
+    order (e.g. from page_index.split_at).
+
+    The files are written by a pool of `processes` (default: number of
+    CPUs). When called from the only thread of the process (e.g. the
+    command line interface), the processes are forked, and inherit the
+    already parsed pages. Otherwise, forking could leave locks held by
+    other threads held forever in the children, so the processes are
+    spawned, and recreate the pages from their files and operations (see
+    session.describe); if they can't, the files are written in this
+    thread. `progress(done, total)` is called as files are written; if it
+    raises, the files not written yet are skipped.
+    """
+    global _split_pages, _split_groups, _split_filenames
+    if groups is None:
+        groups = [[i] for i in range(len(pages))]
+    filenames = split_filenames(fileprefix, len(groups))
+    # pre-check filenames to see if we're overwriting something
+    for filename in filenames:
+        if osp.exists(filename):
+            raise FileExistsError(filename)
+    processes = processes or multiprocessing.cpu_count()
+    total = len(groups)
+    done = 0
+    context = None
+    if processes > 1 and total > 1:
+        if (threading.active_count() == 1 and
+                'fork' in multiprocessing.get_all_start_methods()):
+            context = multiprocessing.get_context('fork')
+            initializer, initargs = _reopen_split_sources, ()
+        else:
+            description = session.describe(pages)
+            if description is not None:
+                context = multiprocessing.get_context('spawn')
+                initializer = _restore_split_pages
+                initargs = (description, groups, filenames)
+    if context is None:
+        for group, filename in zip(groups, filenames):
+            with open(filename, 'wb') as f:
+                write_pages([pages[i] for i in group], f)
+            done += 1
+            if progress is not None:
+                progress(done, total)
+        return filenames
+
+    _split_pages, _split_groups, _split_filenames = pages, groups, filenames
+    try:
+        chunksize = max(1, min(64, total // (processes * 8)))
+        chunks = [range(i, min(i + chunksize, total))
+                  for i in range(0, total, chunksize)]
+        executor = futures.ProcessPoolExecutor(
+            processes, mp_context=context, initializer=initializer,
+            initargs=initargs)
+        try:
+            for future in futures.as_completed(
+                    [executor.submit(profiling.call_recorded,
+                                     _write_split_pages, chunk)
+                     for chunk in chunks]):
+                written, recorded = future.result()
+                profiling.merge(recorded)
+                done += written
+                if progress is not None:
+                    progress(done, total)
+        except BaseException:
+            # Don't start the remaining chunks, e.g. when cancelled
+            executor.shutdown(cancel_futures=True)
+            raise
+        executor.shutdown()
+    finally:
+        _split_pages, _split_groups, _split_filenames = [], [], []
+    return filenames
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Source documents shared by the pages loaded from them, and a process-wide
+cache of parsed documents, so that loading the same file again while its
+pages are open (e.g. a letterhead used for stamping) doesn't reparse it.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import os
+import os.path as osp
+import collections
+import contextlib
+import functools
+import hashlib
+import mmap
+import re
+import threading
+from io import BytesIO
+
+import PyPDF2 as pdf
+
+import pdf_images
+import profiling
+
+
+_refcount_lock = threading.Lock()
+
+
+class MappedFile(mmap.mmap):
+    """A read-only memory map of a file, used by the reader as a file object.
+
+    The reader walks the xref table and objects with many small seeks and
+    reads, which are served from the page cache without system calls, and
+    processes reading the same file share its pages.
+    """
+    def seek(self, pos, whence=os.SEEK_SET):
+        # Maps refuse positions past the end, which files allow (reading
+        # there returns nothing), e.g. for broken xref offsets
+        if whence == os.SEEK_CUR:
+            pos += self.tell()
+        elif whence == os.SEEK_END:
+            pos += len(self)
+        return super(MappedFile, self).seek(min(pos, len(self)))
+
+
+def open_mapped(filename):
+    """Opens a file for reading, memory-mapped if possible (it isn't for
+    empty files, or on some file systems), or else as a regular file.
+    """
+    with open(filename, 'rb') as f:
+        try:
+            return MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            pass
+    return open(filename, 'rb')
+
+
+class SourceDocument(object):
+    """An opened PDF document, shared by all the pages loaded from it.
+
+    The stream is kept open while any page references the document, since
+    the reader only fetches objects from it when they are first needed.
+    Documents can also be created without a stream, and a `convert()`
+    function returning it, which is only called once the document is first
+    read, and again if it's read after `forget()` dropped it.
+    """
+    def __init__(self, stream, name, size=0, filename=None, origin=None,
+                 frame=0, convert=None):
+        self.stream = stream
+        self.name = name
+        self.size = size
+        self.filename = filename
+        # File the document was loaded or converted from, and the frame of
+        # that file for multi-page images
+        self.origin = origin or filename
+        self.frame = frame
+        self._digest = None
+        self._convert = convert
+        self._reader = None
+        # The reader isn't thread safe, e.g. its page list is built on
+        # first use, so the same file can't be loaded by two threads at once
+        self._reader_lock = threading.RLock()
+        if stream is not None:
+            with profiling.span('parse'):
+                self._reader = pdf.PdfFileReader(stream, strict=False)
+        self.refcount = 0
+        self.cache = None
+        # (path, mtime, size) of the file when it was loaded
+        self.fingerprint = None
+        # Page size (cm) and frame (None for single images) of documents
+        # converted from images
+        self.image = None
+        # File state after the last incremental update appended to it, as
+        # (fingerprint, offset of its xref section, number of objects), and
+        # the objects replaced by those updates
+        self._revision = None
+        self.revised = set()
+
+    @classmethod
+    def from_file(cls, filename):
+        fingerprint = DocumentCache.fingerprint(filename)
+        size = fingerprint[2]
+        profiling.count('bytes_read', size)
+        document = cls(open_mapped(filename), osp.basename(filename), size,
+                       filename)
+        document.fingerprint = fingerprint
+        return document
+
+    @classmethod
+    def from_image(cls, filename, page_size_cm, data=None, frame=None,
+                   lazy=False):
+        """`data` is the image already converted to PDF, if it was (e.g. by
+        pdf_images.convert_image in another process).
+
+        `frame` is the frame to show of a multi-page image. Frames are only
+        converted when first read, so that loading a file with many frames
+        doesn't convert them all at once. With `lazy`, single images are
+        also converted when first read.
+        """
+        convert = functools.partial(pdf_images.image_to_pdf, filename,
+                                    page_size_cm, frame or 0)
+        if frame is not None or (lazy and data is None):
+            document = cls(None, osp.basename(filename), origin=filename,
+                           frame=frame or 0, convert=convert)
+        else:
+            if data is not None:
+                tmp = BytesIO(data)
+            else:
+                tmp = convert()
+            document = cls(tmp, osp.basename(filename), len(tmp.getvalue()),
+                           origin=filename, convert=convert)
+        document.image = (tuple(page_size_cm), frame)
+        return document
+
+    @property
+    def reader(self):
+        reader = self._reader
+        if reader is None:
+            with self._reader_lock:
+                if self._reader is None:
+                    self.stream = self._convert()
+                    self.size = len(self.stream.getvalue())
+                    with profiling.span('parse'):
+                        self._reader = pdf.PdfFileReader(self.stream,
+                                                         strict=False)
+                reader = self._reader
+        return reader
+
+    @property
+    def digest(self):
+        """SHA-1 (hex) of the contents of the file the document came from,
+        computed once. The file is read separately from the reader's stream,
+        so this is safe to call from another thread.
+        """
+        if self._digest is None:
+            if self.changed:
+                self._digest = hashlib.sha1(self.data()).hexdigest()
+                return self._digest
+            h = hashlib.sha1()
+            with open(self.origin, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    h.update(chunk)
+            self._digest = h.hexdigest()
+        return self._digest
+
+    @property
+    def changed(self):
+        """Tells if the document's file no longer holds the document as it
+        was loaded: it was updated since, or the document was detached from
+        it (see `detach`). Its pages must then be read from the document.
+        Documents converted from images are never changed.
+        """
+        return self.image is None and (self.filename is None or
+                                       bool(self.revised))
+
+    def data(self):
+        """Returns the contents of the document, as it was loaded: files
+        updated since are only appended to, past its size.
+        """
+        with self._reader_lock:
+            stream = self.reader.stream
+            position = stream.tell()
+            stream.seek(0)
+            data = stream.read(self.size or -1)
+            stream.seek(position)
+        return data
+
+    def getNumPages(self):
+        with self._reader_lock:
+            return self.reader.getNumPages()
+
+    def copy_page(self, page_number):
+        """Returns a shallow copy of a page, so that transforming it doesn't
+        affect the other pages referencing the same page of the document.
+        """
+        with self._reader_lock:
+            original = self.reader.getPage(page_number)
+            page = pdf.pdf.PageObject(self.reader, original.indirectRef)
+            page.update(original)
+        return page
+
+    def forget(self):
+        """Drops the objects the reader resolved, which it otherwise keeps
+        for as long as the document is open. They're read again if needed.
+        Documents converted from images drop their converted data too, and
+        are converted again if needed, so that writing the frames of a large
+        multi-page image doesn't keep them all.
+        """
+        with self._reader_lock:
+            if self._reader is None:
+                return
+            if self._convert is not None:
+                # Page objects already read keep the reader they came from
+                self._reader = None
+                self.stream = None
+                self.size = 0
+            else:
+                self._reader.resolvedObjects.clear()
+
+    def revision(self):
+        """Returns the offset of the last cross-reference section of the
+        document's file, and its number of objects, for appending an
+        incremental update (pg 109) to it.
+
+        The file must be as it was loaded, or as the last update appended
+        by `appended()` left it. Returns None if it isn't, or if the
+        section is a cross-reference stream, which an update with a table
+        shouldn't follow, or the document is encrypted.
+        """
+        if self.filename is None or self.reader.isEncrypted:
+            return None
+        try:
+            fingerprint = DocumentCache.fingerprint(self.filename)
+        except OSError:
+            return None
+        if self._revision is not None:
+            expected, startxref, size = self._revision
+            return (startxref, size) if fingerprint == expected else None
+        if fingerprint != self.fingerprint:
+            return None
+        with open(self.filename, 'rb') as f:
+            f.seek(max(0, fingerprint[2] - 1024))
+            found = re.findall(br'startxref\s+(\d+)', f.read())
+            if not found:
+                return None
+            startxref = int(found[-1])
+            f.seek(startxref)
+            if not f.read(4) == b'xref':
+                return None
+        return startxref, int(self.reader.trailer['/Size'])
+
+    def appended(self, startxref, size, replaced):
+        """Records an incremental update appended to the document's file,
+        with its cross-reference section at `startxref`, `size` objects,
+        and replacing the objects `replaced`.
+        """
+        self._revision = (DocumentCache.fingerprint(self.filename), startxref,
+                          size)
+        self.revised.update(replaced)
+
+    def detach(self):
+        """Reads the document's file into memory and closes it, so that the
+        file can be replaced (on Windows, open or mapped files can't be).
+        The document no longer refers to the file afterwards.
+        """
+        with self._reader_lock:
+            if self.filename is None or self.stream is None:
+                return
+            stream = self.stream
+            stream.seek(0)
+            data = stream.read()
+            if self._digest is None:
+                self._digest = hashlib.sha1(data).hexdigest()
+            self.stream = BytesIO(data)
+            self.reader.stream = self.stream
+            self.filename = None
+            stream.close()
+
+    def acquire(self):
+        with _refcount_lock:
+            self.refcount += 1
+
+    def release(self):
+        with _refcount_lock:
+            self.refcount -= 1
+            idle = self.refcount == 0
+        if idle and self.cache is not None:
+            self.cache.trim()
+
+    def reopen(self):
+        """Gives the reader a new file object for the same file, e.g. in a
+        forked process, which would otherwise share the file position with
+        its parent.
+        """
+        if self.filename is not None:
+            self.stream = open_mapped(self.filename)
+            self.reader.stream = self.stream
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+
+@contextlib.contextmanager
+def locked(sources):
+    """Holds the reader locks of `sources`, e.g. to read pages in another
+    thread than the one owning them. Locks are taken in a fixed order, so
+    that two threads locking the same documents can't deadlock.
+    """
+    with contextlib.ExitStack() as stack:
+        for source in sorted(set(sources), key=id):
+            stack.enter_context(source._reader_lock)
+        yield
+
+
+class DocumentCache(object):
+    """Process-wide cache of parsed documents, keyed by path, modification
+    time and size.
+
+    Documents are reference counted by the pages using them. Documents
+    read from a file are closed once no pages are left, so that the file
+    isn't kept open. Others (converted from images) are kept, until there
+    are more than `max_documents` open documents or they add up to more
+    than `max_bytes`, and the least recently used ones are closed.
+    """
+    def __init__(self, max_documents=64, max_bytes=256 * 2**20):
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self._documents = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def fingerprint(filename):
+        stat = os.stat(filename)
+        return (osp.normcase(osp.abspath(filename)), stat.st_mtime,
+                stat.st_size)
+
+    def _get(self, key, factory, *args):
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+                document.acquire()
+                return document
+        document = factory(*args)
+        document.cache = self
+        with self._lock:
+            # Another thread may have loaded the same document meanwhile
+            if key in self._documents:
+                document.close()
+                document = self._documents[key]
+                self._documents.move_to_end(key)
+            else:
+                self._documents[key] = document
+            document.acquire()
+        self.trim()
+        return document
+
+    def open(self, filename):
+        """Returns the parsed document for a PDF file.
+
+        The caller owns a reference to the document, and must release() it
+        once the pages loaded from it hold their own references.
+        """
+        key = self.fingerprint(filename)
+        return self._get(key, SourceDocument.from_file, filename)
+
+    def open_image(self, filename, page_size_cm, data=None, frame=None,
+                   lazy=False):
+        """Returns the single page document converted from an image file
+        (or from its `frame`-th frame, see SourceDocument.from_image), or
+        from `data`, if it was already converted.
+        """
+        key = self.fingerprint(filename) + (tuple(page_size_cm), frame)
+        return self._get(key, SourceDocument.from_image, filename,
+                         page_size_cm, data, frame, lazy)
+
+    def trim(self):
+        """Closes idle documents read from files, and others, least recently
+        used first, until the cache is within its budget.
+        """
+        with self._lock:
+            total_bytes = sum(document.size
+                              for document in self._documents.values())
+            for key, document in list(self._documents.items()):
+                if document.refcount > 0:
+                    continue
+                if (document.filename is None and
+                        len(self._documents) <= self.max_documents and
+                        total_bytes <= self.max_bytes):
+                    continue
+                del self._documents[key]
+                total_bytes -= document.size
+                document.close()
+
+    def release_file(self, filename):
+        """Closes the documents read from `filename`, or detaches those
+        still used by pages (see SourceDocument.detach), so that the file
+        can be replaced.
+        """
+        path = osp.normcase(osp.abspath(filename))
+        with self._lock:
+            for key, document in list(self._documents.items()):
+                if key[0] != path or document.filename is None:
+                    continue
+                del self._documents[key]
+                document.cache = None
+                if document.refcount > 0:
+                    document.detach()
+                else:
+                    document.close()
+
+    def clear(self):
+        """Closes all idle documents."""
+        with self._lock:
+            for key, document in list(self._documents.items()):
+                if document.refcount == 0:
+                    del self._documents[key]
+                    document.close()
+
+
+cache = DocumentCache()
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Streaming PDF writer. Unlike PyPDF2's PdfFileWriter, which keeps the whole
+object graph in memory until write() is called (and rewrites the source
+documents' objects while doing so), objects are serialized to the output as
+soon as a page referencing them is added, and aren't kept afterwards. What
+grows with the number of pages written is the mapping of the objects
+written to their numbers in the output, a few small entries per object.
+
+Links:
+PDF format: http://www.adobe.com/content/dam/Adobe/en/devnet/acrobat/pdfs/pdf_reference_1-7.pdf
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import collections
+import hashlib
+import itertools
+import weakref
+from io import BytesIO
+
+import PyPDF2 as pdf
+from PyPDF2.generic import (IndirectObject, DictionaryObject, ArrayObject,
+                            StreamObject, NameObject, NumberObject)
+
+
+class _CountingStream(object):
+    """Keeps track of the output offset, so the output doesn't need to be
+    seekable.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.offset = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.offset += len(data)
+
+
+class StreamingPdfWriter(object):
+    """Writes pages to `stream` as they are added.
+
+    Every object is written once, the first time a page references it, so
+    resources shared by several pages (fonts, images, ICC profiles) are only
+    output once. References to pages that haven't been added yet are kept
+    as placeholders, filled when the page is added, or written as null by
+    close() otherwise.
+
+    With `dedup`, objects are also identified by a hash of their contents
+    (including the contents of the objects they reference), so identical
+    resources coming from different documents, e.g. the same font in files
+    that were split and are now being joined, are written only once.
+    """
+    # Objects referenced through more levels than this aren't deduplicated
+    max_digest_depth = 64
+
+    def __init__(self, stream, dedup=True):
+        self.stream = _CountingStream(stream)
+        self.dedup = dedup
+        self._offsets = [None]  # Object 0 is always free
+        # Documents the objects come from, numbered while they're alive,
+        # so that the objects written don't keep them (and their streams)
+        # in memory
+        self._documents = weakref.WeakKeyDictionary()
+        self._serials = itertools.count()
+        self._ids = {}  # (document number, idnum, generation) -> output idnum
+        self._direct = {}  # id(stream) -> output idnum, while it's alive
+        # (document number, idnum, generation) -> digest, until the object
+        # is written
+        self._digests = {}
+        self._digest_ids = {}  # digest -> output idnum
+        self._queue = collections.deque()
+        self._placeholders = set()
+        self._kids = []
+        self._start()
+
+    def _start(self):
+        self.stream.write(b"%PDF-1.7\n%\xE2\xE3\xCF\xD3\n")
+        self._pages_id = self._allocate()
+
+    def _allocate(self):
+        self._offsets.append(None)
+        return len(self._offsets) - 1
+
+    def _key(self, ref):
+        serial = self._documents.get(ref.pdf)
+        if serial is None:
+            serial = self._documents[ref.pdf] = next(self._serials)
+        return (serial, ref.idnum, ref.generation)
+
+    @staticmethod
+    def _is_page(obj):
+        return isinstance(obj, DictionaryObject) and obj.get('/Type') == '/Page'
+
+    @staticmethod
+    def _written_digest(idnum):
+        return hashlib.sha1("written {}".format(idnum).encode('ascii')) \
+            .digest()
+
+    @staticmethod
+    def _reference_digest(key):
+        return hashlib.sha1(repr(key).encode('ascii')).digest()
+
+    def _digest(self, obj, stack):
+        """Returns a hash of an object's contents, following references.
+        Pages, and objects that take part in reference cycles, hash by their
+        reference, so they're never merged with other objects.
+        """
+        if isinstance(obj, IndirectObject):
+            key = self._key(obj)
+            # Objects written hash by their output number, which identical
+            # objects share
+            idnum = self._ids.get(key)
+            if idnum is not None and idnum not in self._placeholders:
+                return self._written_digest(idnum)
+            digest = self._digests.get(key)
+            if digest is not None:
+                return digest
+            if obj.pdf is self or key in stack or \
+                    len(stack) >= self.max_digest_depth:
+                return self._reference_digest(key)
+            resolved = obj.getObject()
+            if self._is_page(resolved):
+                digest = self._reference_digest(key)
+            else:
+                stack.append(key)
+                digest = self._digest(resolved, stack)
+                stack.pop()
+            self._digests[key] = digest
+            return digest
+        h = hashlib.sha1()
+        if isinstance(obj, DictionaryObject):
+            h.update(b"<<")
+            for key in sorted(obj):
+                if isinstance(obj, StreamObject) and key == '/Length':
+                    continue
+                h.update(key.encode('utf-8'))
+                h.update(self._digest(obj.raw_get(key), stack))
+            if isinstance(obj, StreamObject):
+                h.update(b"stream")
+                h.update(obj._data)
+        elif isinstance(obj, ArrayObject):
+            h.update(b"[")
+            for value in obj:
+                h.update(self._digest(value, stack))
+        else:
+            h.update(type(obj).__name__.encode('ascii'))
+            buf = BytesIO()
+            obj.writeToStream(buf, None)
+            h.update(buf.getvalue())
+        return h.digest()
+
+    def _id(self, ref):
+        """Returns the output idnum for an indirect reference, queueing the
+        object to be written if it's the first time it's referenced.
+        """
+        key = self._key(ref)
+        idnum = self._ids.get(key)
+        if idnum is None:
+            obj = ref.getObject()
+            if self._is_page(obj):
+                idnum = self._ids[key] = self._allocate()
+                self._placeholders.add(idnum)
+                return idnum
+            if self.dedup:
+                digest = self._digest(ref, [])
+                self._digests.pop(key, None)
+                idnum = self._digest_ids.get(digest)
+                if idnum is not None:
+                    self._ids[key] = idnum
+                    return idnum
+            idnum = self._ids[key] = self._allocate()
+            if self.dedup:
+                self._digest_ids[digest] = idnum
+            self._queue.append((idnum, obj))
+        return idnum
+
+    def _direct_stream_id(self, obj):
+        """Returns the output idnum for a stream stored as a direct object
+        (e.g. a merged page's contents), as streams must be indirect.
+        """
+        idnum = self._direct.get(id(obj))
+        if idnum is not None:
+            return idnum
+        if self.dedup:
+            digest = self._digest(obj, [])
+            idnum = self._digest_ids.get(digest)
+        if idnum is None:
+            idnum = self._allocate()
+            if self.dedup:
+                self._digest_ids[digest] = idnum
+            self._queue.append((idnum, obj))
+        # Forgotten with the stream, whose id may then be reused
+        self._direct[id(obj)] = idnum
+        weakref.finalize(obj, self._direct.pop, id(obj), None)
+        return idnum
+
+    def _write_value(self, obj, top=False):
+        write = self.stream.write
+        if isinstance(obj, IndirectObject):
+            if obj.pdf is self:
+                idnum = obj.idnum
+            else:
+                idnum = self._id(obj)
+            write("{} 0 R".format(idnum).encode('ascii'))
+        elif isinstance(obj, StreamObject) and not top:
+            write("{} 0 R".format(self._direct_stream_id(obj)).encode('ascii'))
+        elif isinstance(obj, DictionaryObject):
+            is_stream = isinstance(obj, StreamObject)
+            write(b"<<\n")
+            for key, value in obj.items():
+                if is_stream and key == '/Length':
+                    continue
+                key.writeToStream(self.stream, None)
+                write(b" ")
+                self._write_value(value)
+                write(b"\n")
+            if is_stream:
+                data = obj._data
+                write("/Length {}\n".format(len(data)).encode('ascii'))
+                write(b">>\nstream\n")
+                write(data)
+                write(b"\nendstream")
+            else:
+                write(b">>")
+        elif isinstance(obj, ArrayObject):
+            write(b"[")
+            for i, value in enumerate(obj):
+                if i:
+                    write(b" ")
+                self._write_value(value)
+            write(b"]")
+        else:
+            obj.writeToStream(self.stream, None)
+
+    def _write_object(self, idnum, obj):
+        self._offsets[idnum] = self.stream.offset
+        self.stream.write("{} 0 obj\n".format(idnum).encode('ascii'))
+        self._write_value(obj, top=True)
+        self.stream.write(b"\nendobj\n")
+
+    def _flush(self):
+        while self._queue:
+            self._write_object(*self._queue.popleft())
+
+    def _page_id(self, page):
+        """Returns the output idnum for a page being added."""
+        idnum = None
+        if page.indirectRef is not None:
+            key = self._key(page.indirectRef)
+            if self._ids.get(key) in self._placeholders:
+                idnum = self._ids[key]
+                self._placeholders.discard(idnum)
+            elif key not in self._ids:
+                # Other objects referencing the page (e.g. annotations)
+                # point to this copy
+                idnum = self._ids[key] = self._allocate()
+        if idnum is None:
+            idnum = self._allocate()
+        return idnum
+
+    def _write_page(self, idnum, page, parent=True):
+        page = DictionaryObject(page)
+        if parent:
+            page[pdf.generic.NameObject('/Parent')] = IndirectObject(
+                self._pages_id, 0, self)
+        self._kids.append(idnum)
+        # The queue references the page, so write it through the queue
+        self._queue.append((idnum, page))
+        self._flush()
+
+    def add_page(self, page):
+        """Writes a page object and every object it references that hasn't
+        been written yet.
+        """
+        self._write_page(self._page_id(page), page)
+
+    def _write_placeholders(self):
+        for idnum in self._placeholders:  # pages never added
+            self._write_object(idnum, pdf.generic.NullObject())
+        self._placeholders.clear()
+
+    def _write_page_tree(self):
+        write = self.stream.write
+        self._offsets[self._pages_id] = self.stream.offset
+        write("{} 0 obj\n<<\n/Type /Pages\n/Count {}\n/Kids [".format(
+            self._pages_id, len(self._kids)).encode('ascii'))
+        write(" ".join("{} 0 R".format(kid) for kid in self._kids)
+              .encode('ascii'))
+        write(b"]\n>>\nendobj\n")
+
+    def close(self):
+        """Writes the page tree, the catalog, the cross-reference table and
+        the trailer. The stream itself isn't closed.
+        """
+        self._write_placeholders()
+        self._write_page_tree()
+
+        write = self.stream.write
+        root_id = self._allocate()
+        self._offsets[root_id] = self.stream.offset
+        write("{} 0 obj\n<<\n/Type /Catalog\n/Pages {} 0 R\n>>\nendobj\n"
+              .format(root_id, self._pages_id).encode('ascii'))
+
+        xref_location = self.stream.offset
+        write("xref\n0 {}\n".format(len(self._offsets)).encode('ascii'))
+        write(b"0000000000 65535 f \n")
+        for offset in self._offsets[1:]:
+            if offset is None:
+                write(b"0000000000 00000 f \n")
+            else:
+                write("{:010d} 00000 n \n".format(offset).encode('ascii'))
+        write("trailer\n<<\n/Size {}\n/Root {} 0 R\n>>\nstartxref\n{}\n%%EOF\n"
+              .format(len(self._offsets), root_id, xref_location)
+              .encode('ascii'))
+        # Kept alive by the streams that outlive the writer, e.g. stamps
+        self._direct.clear()
+
+
+class IncrementalPdfWriter(StreamingPdfWriter):
+    """Writes an incremental update (pg 109) of the document read by
+    `reader` to `stream`, which is positioned at `offset`, the end of the
+    document. `prev` is the offset of the document's last cross-reference
+    section, and `size` its number of objects.
+
+    The document's objects are referenced by their own numbers instead of
+    being written again, so the update only holds the pages added, and the
+    new or other documents' objects they reference. A page of the document
+    replaces its original object, the first time it's added.
+
+    With `keep_tree`, the document's page tree is kept as it is, and pages
+    added keep their /Parent; the pages must be the document's, in order.
+    Otherwise, a new page tree replaces the document's root /Pages, with
+    the pages added, or kept from the document (see `keep_page`), in order.
+    The new root keeps the attributes pages inherit from the old one.
+    """
+    # Page attributes inherited from the page tree (pg 149)
+    inheritable = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+    def __init__(self, stream, reader, offset, prev, size, keep_tree=False):
+        self.reader = reader
+        self.offset = offset
+        self.prev = prev
+        self.size = size
+        self.keep_tree = keep_tree
+        # Objects of the document replaced by the update
+        self.replaced = set()
+        self._added = set()  # idnums of the pages added or kept
+        super(IncrementalPdfWriter, self).__init__(stream)
+
+    def _start(self):
+        self.stream.offset = self.offset
+        # Objects below `size` are the document's, and are only written
+        # (and listed in the cross-reference section) if replaced
+        self._offsets = [None] * self.size
+        pages_ref = self.pages_ref()
+        self._pages_id = pages_ref.idnum
+        # Kept pages are children of the root (see keep_page), so this is
+        # all they inherit
+        pages = pages_ref.getObject()
+        self._inherited = {NameObject(key): pages.raw_get(key)
+                           for key in self.inheritable if key in pages}
+
+    def pages_ref(self):
+        """Reference to the document's root /Pages."""
+        return self.reader.trailer['/Root'].getObject().raw_get('/Pages')
+
+    def _digest(self, obj, stack):
+        # The document's objects aren't copied, so they can't be merged
+        if isinstance(obj, IndirectObject) and obj.pdf is self.reader:
+            return self._reference_digest(self._key(obj))
+        return super(IncrementalPdfWriter, self)._digest(obj, stack)
+
+    def _write_value(self, obj, top=False):
+        if isinstance(obj, IndirectObject) and obj.pdf is self.reader:
+            self.stream.write("{} {} R".format(obj.idnum, obj.generation)
+                              .encode('ascii'))
+        else:
+            super(IncrementalPdfWriter, self)._write_value(obj, top)
+
+    def keep_page(self, ref):
+        """Adds the document's page `ref` as it is in the file, without
+        writing it, if it can be: it must not have been added yet, and if
+        the page tree is replaced, its /Parent must be the root /Pages.
+        Returns whether the page was kept.
+        """
+        if ref.idnum in self._added:
+            return False
+        if not self.keep_tree:
+            page = ref.getObject()
+            if '/Parent' not in page or \
+                    page.raw_get('/Parent').idnum != self._pages_id:
+                return False
+        self._added.add(ref.idnum)
+        self._kids.append(ref.idnum)
+        return True
+
+    def add_page(self, page, ref=None):
+        """Writes a page object, replacing the document's page `ref` (by
+        default, the page's own reference), e.g. when rendering the page
+        made a new page object, as for backgrounds.
+        """
+        if ref is None:
+            ref = page.indirectRef
+        if ref is not None and ref.pdf is self.reader and \
+                ref.generation == 0 and ref.idnum not in self._added:
+            idnum = ref.idnum
+            self.replaced.add(idnum)
+            if self.keep_tree and '/Parent' not in page:
+                # Stay in the document's page tree
+                page = DictionaryObject(page)
+                page[pdf.generic.NameObject('/Parent')] = \
+                    ref.getObject().raw_get('/Parent')
+        else:
+            idnum = self._page_id(page)
+        self._added.add(idnum)
+        self._write_page(idnum, page, parent=not self.keep_tree)
+
+    def _write_page(self, idnum, page, parent=True):
+        if parent and self._inherited:
+            # Pages written have their attributes set, inherited or not, so
+            # they don't inherit those of the new root
+            page = DictionaryObject(page)
+            defaults = {'/Rotate': NumberObject(0),
+                        '/Resources': DictionaryObject()}
+            if '/MediaBox' in page:
+                defaults['/CropBox'] = page.raw_get('/MediaBox')
+            for key in self._inherited:
+                if key not in page and key in defaults:
+                    page[NameObject(key)] = defaults[key]
+        super(IncrementalPdfWriter, self)._write_page(idnum, page, parent)
+
+    def _write_page_tree(self):
+        tree = DictionaryObject(self._inherited)
+        tree[NameObject('/Type')] = NameObject('/Pages')
+        tree[NameObject('/Count')] = NumberObject(len(self._kids))
+        tree[NameObject('/Kids')] = ArrayObject(
+            IndirectObject(kid, 0, self) for kid in self._kids)
+        self._write_object(self._pages_id, tree)
+        self._flush()
+
+    def close(self):
+        """Writes the page tree, unless kept, the cross-reference section
+        of the objects written, and the trailer, pointing to the document's
+        last cross-reference section. The stream itself isn't closed.
+        """
+        self._write_placeholders()
+        if not self.keep_tree:
+            self._write_page_tree()
+            self.replaced.add(self._pages_id)
+
+        write = self.stream.write
+        self.xref_location = self.stream.offset
+        written = [idnum for idnum, offset in enumerate(self._offsets)
+                   if offset is not None]
+        # The free list head is listed as usual, as some readers take a
+        # section that doesn't start at 0 for a misnumbered table
+        write(b"xref\n0 1\n0000000000 65535 f \n")
+        # Subsections of consecutive objects (pg 94)
+        start = 0
+        for i in range(1, len(written) + 1):
+            if i == len(written) or written[i] != written[i - 1] + 1:
+                write("{} {}\n".format(written[start], i - start)
+                      .encode('ascii'))
+                for idnum in written[start:i]:
+                    write("{:010d} 00000 n \n".format(self._offsets[idnum])
+                          .encode('ascii'))
+                start = i
+        self.size = len(self._offsets)
+        write("trailer\n<<\n/Size {}\n/Prev {}\n".format(self.size, self.prev)
+              .encode('ascii'))
+        for key in ('/Root', '/Info', '/ID'):
+            if key in self.reader.trailer:
+                write(key.encode('ascii') + b" ")
+                self._write_value(self.reader.trailer.raw_get(key))
+                write(b"\n")
+        write(">>\nstartxref\n{}\n%%EOF\n".format(self.xref_location)
+              .encode('ascii'))
+        self._direct.clear()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Lightweight instrumentation of the page pipeline: named spans timing each
+stage (parsing, rendering, merging, decoding, writing) and counters (pages
+loaded, bytes read and written, images decoded by filter), always on, plus
+an optional cProfile and tracemalloc capture. The results are exported as a
+JSON report. This module must not import Qt.
+
+Capture is enabled with the PYPDFTK_PROFILE environment variable, holding
+a comma separated list of "cprofile" and "tracemalloc", or with the
+command line interface's --profile option. If PYPDFTK_PROFILE_REPORT is
+set, the GUI writes the report there when closed.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import os
+import io
+import json
+import time
+import threading
+import contextlib
+import collections
+import cProfile
+import pstats
+import tracemalloc
+
+
+capture_modes = ['cprofile', 'tracemalloc']
+
+_lock = threading.Lock()
+_spans = collections.defaultdict(lambda: [0, 0.])  # name -> [calls, seconds]
+_counters = collections.Counter()
+_capture = set()
+_stats = None  # pstats.Stats of all the profiled runs
+
+
+@contextlib.contextmanager
+def span(name):
+    """Times the code run inside it as the stage `name`. Nested spans are
+    timed separately, so their times overlap.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def add_time(name, seconds, calls=1):
+    """Adds time spent in the stage `name`, e.g. measured in a worker
+    process, whose own spans aren't seen here.
+    """
+    with _lock:
+        entry = _spans[name]
+        entry[0] += calls
+        entry[1] += seconds
+
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+
+def recorded():
+    """Returns the spans and counters recorded so far, as ({name: [calls,
+    seconds]}, {name: count}).
+    """
+    with _lock:
+        return ({name: list(entry) for name, entry in _spans.items()},
+                dict(_counters))
+
+
+def changes(since):
+    """Returns the spans and counters recorded after `since`, an earlier
+    `recorded()`, in the same form.
+    """
+    spans, counters = recorded()
+    for name, (calls, seconds) in since[0].items():
+        if name in spans:
+            spans[name][0] -= calls
+            spans[name][1] -= seconds
+    for name, n in since[1].items():
+        if name in counters:
+            counters[name] -= n
+    return ({name: entry for name, entry in spans.items() if entry[0]},
+            {name: n for name, n in counters.items() if n})
+
+
+def merge(other):
+    """Adds spans and counters recorded elsewhere (see `call_recorded`)."""
+    spans, counters = other
+    for name, (calls, seconds) in spans.items():
+        add_time(name, seconds, calls)
+    for name, n in counters.items():
+        count(name, n)
+
+
+def call_recorded(function, *args):
+    """Calls `function(*args)`, e.g. in a worker process, whose spans and
+    counters aren't seen by the parent. Returns its result and what it
+    recorded, to be passed to `merge()` in the parent.
+    """
+    since = recorded()
+    return function(*args), changes(since)
+
+
+def enable(modes):
+    """Enables the capture `modes` (see `capture_modes`). tracemalloc
+    starts tracing right away; cProfile profiles the code run inside
+    `profiled()`.
+    """
+    for mode in modes:
+        if mode not in capture_modes:
+            raise ValueError("unknown profiling mode {}".format(mode))
+        _capture.add(mode)
+    if 'tracemalloc' in _capture and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def enable_from_environment():
+    modes = os.environ.get('PYPDFTK_PROFILE', '')
+    enable([mode.strip() for mode in modes.split(',') if mode.strip()])
+
+
+@contextlib.contextmanager
+def profiled():
+    """Profiles the code run inside it with cProfile, if enabled. cProfile
+    only sees the thread it runs in, so each background task is profiled
+    separately, and all the runs are added up in the report.
+    """
+    global _stats
+    if 'cprofile' not in _capture:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        with _lock:
+            if _stats is None:
+                _stats = pstats.Stats(profile, stream=io.StringIO())
+            else:
+                _stats.add(profile)
+
+
+def reset():
+    global _stats
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _stats = None
+    if tracemalloc.is_tracing():
+        tracemalloc.clear_traces()
+
+
+def report(top=30):
+    """Returns the spans ({name: {'calls', 'seconds'}}) and counters, plus
+    the `top` functions by cumulative time and the `top` allocation sites
+    by size, when captured.
+    """
+    with _lock:
+        result = {
+            'spans': {name: {'calls': calls, 'seconds': seconds}
+                      for name, (calls, seconds) in _spans.items()},
+            'counters': dict(_counters),
+        }
+        stats = _stats
+    if stats is not None:
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3],
+                           reverse=True)[:top]
+        result['cprofile'] = [
+            {'function': "{}:{}({})".format(*function), 'calls': nc,
+             'primitive_calls': cc, 'seconds': tt, 'cumulative': ct}
+            for function, (cc, nc, tt, ct, callers) in functions]
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        result['tracemalloc'] = {
+            'current': current, 'peak': peak,
+            'top': [{'location': str(stat.traceback), 'bytes': stat.size,
+                     'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:top]]}
+    return result
+
+
+def write_report(filename):
+    """Writes the report as JSON, and the raw cProfile data, when captured,
+    to `filename` + ".prof", for pstats or other viewers.
+    """
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=1, sort_keys=True)
+    with _lock:
+        if _stats is not None:
+            _stats.dump_stats(filename + '.prof')
+
+
+def _bytes(n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024:
+            return "{:.0f} {}".format(n, unit)
+        n /= 1024
+    return "{:.1f} GB".format(n)
+
+
+def summary(since=None):
+    """A one line summary of the spans and main counters, e.g. for a status
+    bar. With `since`, from an earlier `recorded()`, only what was recorded
+    after it is summarized.
+    """
+    spans, counters = changes(since) if since is not None else recorded()
+    parts = ["{} {:.2f}s".format(name, seconds)
+             for name, (calls, seconds) in sorted(spans.items()) if calls]
+    if counters.get('pages_loaded'):
+        parts.append("{} pages loaded".format(counters['pages_loaded']))
+    if counters.get('bytes_read'):
+        parts.append("{} read".format(_bytes(counters['bytes_read'])))
+    if counters.get('bytes_written'):
+        parts.append("{} written".format(_bytes(counters['bytes_written'])))
+    images = sum(n for name, n in counters.items()
+                 if name.startswith('images_decoded'))
+    if images:
+        parts.append("{} images decoded".format(images))
+    return ", ".join(parts)
@@ -15,15 +15,12 @@ from __future__ import division, unicode_literals, print_function
 import sys
 import os
 import os.path as osp
-import uuid
-try:
-    from cStringIO import StringIO as BytesIO
-except ModuleNotFoundError:  # Py3
-    from io import BytesIO
 import subprocess
 from decimal import Decimal, InvalidOperation
 import copy
+import contextlib
 import ctypes
+import multiprocessing
 import traceback
 
 
@@ -37,13 +34,17 @@ for name in API_NAMES:
 #%%
 from qtpy import QtCore, QtGui, QtWidgets, uic
 
-import PyPDF2 as pdf
-from PIL import Image
-
+import page_index
 import pdf_images
+import pdf_pages
+import profiling
+import session
+import tasks
+import thumbnails
 
 # Need to import promoted qt classes, to make py2exe process them.
 import dragdroplist
+import pagelist
 import six
 
 if sys.platform == 'darwin':
@@ -71,115 +72,117 @@ def frozen(filename):
     else:
         return filename
 
-#%%
-class Page(object):
-    def __init__(self):
-        self.tmp = BytesIO()
-        self.uuid = uuid.uuid4()
-        self.obj = None
-        self.transforms = ""
-        self._numbers = []
-        self._basename = "Invalid Page"
-
-    def reload_from_buffer(self):
-        self.tmp.seek(0)
-        reader = pdf.PdfFileReader(self.tmp, strict=False)
-        self.obj = reader.getPage(0)
-
-    @classmethod
-    def from_file(cls, filename):
-        pages = []
-        with open(filename, 'rb') as f:
-            reader = pdf.PdfFileReader(f, strict=False)
-            total_pages = reader.getNumPages()
-            for page_number in range(total_pages):
-                page = Page()
-                output = pdf.PdfFileWriter()
-                output.addPage(reader.getPage(page_number))
-                output.write(page.tmp)
-                page.reload_from_buffer()
-                page._numbers = [str(page_number + 1)]
-                page._basename = osp.basename(filename)
-                pages.append(page)
-        return pages
-
-    @classmethod
-    def from_image(cls, filename, page_size_cm):
-        page = Page()
-        page.tmp = pdf_images.image_to_pdf(filename, page_size_cm)
-        page.reload_from_buffer()
-        page._basename = osp.basename(filename)
-        page._numbers = ["I"]
-        return page
-
-    def rotateLeft(self):
-        self.obj.rotateCounterClockwise(90)
-        self.transforms += '↺'
-        if self.transforms.endswith('↻↺'):
-            self.transforms = self.transforms[:-2]
-        if self.transforms.endswith('↺↺↺'):
-            self.transforms = self.transforms[:-3]+'↻'
-
-    def rotateRight(self):
-        self.obj.rotateClockwise(90)
-        self.transforms += '↻'
-        if self.transforms.endswith('↺↻'):
-            self.transforms = self.transforms[:-2]
-        if self.transforms.endswith('↻↻↻'):
-            self.transforms = self.transforms[:-3]+'↺'
-
-    @classmethod
-    def merge_pageobjs(cls, page1, page2, tx, ty):
-        rotation = int(page2.get("/Rotate") or 0) % 360
-        scale = Decimal(1.)
-        # rotation is clockwise. tx, ty in page1 coordinates: x = right; y = up
-        if rotation == 90:
-#            tx += 0
-            ty += page1.mediaBox.getHeight()
-        elif rotation == 180:
-            tx += page2.mediaBox.getWidth()*scale
-            ty += page1.mediaBox.getHeight()
-        elif rotation == 270:
-            tx += page2.mediaBox.getHeight()*scale
-            ty += page1.mediaBox.getHeight() - page2.mediaBox.getWidth()*scale
-        page1.mergeRotatedScaledTranslatedPage(page2, -rotation, scale, tx, ty)
-
-    def merge(self, page, tx=0.0, ty=0.0, op="merge"):
-        """op in ['merge', 'stamp', 'background']"""
-        assert(op in ["merge", "stamp", "background"])
-        if op == "background":
-            page0 = pdf.pdf.PageObject.createBlankPage(self.tmp,
-                self.obj.mediaBox.getWidth(), self.obj.mediaBox.getHeight())
-            Page.merge_pageobjs(page0, page.obj, tx, ty)
-            tx = ty = 0
-            page2 = self.obj
-            self.obj = page0
-        else:
-            page2 = page.obj
-        self.merge_pageobjs(self.obj, page2, tx, ty)
-        # Adjust name
-        if op == "merge":
-            if self._basename == page._basename:
-                self._numbers.append(','.join(page._numbers))
-            else:
-                self._numbers.append(u"{0}<{1}>".format(page._basename,
-                                     ','.join(page._numbers)))
-            self.transforms += "M"
-        elif op == "stamp":
-            self.transforms += "⊙"
-        elif op == "background":
-            self.uuid = page.uuid
-            self._numbers = page._numbers
-            self.transforms = page.transforms + "▣"
-            self._basename = page._basename
-
-    @property
-    def name(self):
-        return u"{0}<{1}>[{2}]".format(self._basename,
-                                       ','.join(self._numbers),
-                                       self.transforms)
+
+#%% Background tasks, run by tasks.Task outside the main thread
+def load_files_task(task, filenames, dpi):
+    """Loads the files concurrently, delivering (index, pages, traceback)
+    results as each file finishes (see pdf_pages.load_files), with the
+    traceback set if the file couldn't be loaded.
+    """
+    with contextlib.closing(pdf_pages.load_files(filenames, dpi)) as results:
+        for done, (i, pages, error) in enumerate(results):
+            tb = None
+            if error is not None:
+                tb = "".join(traceback.format_exception(
+                    type(error), error, error.__traceback__))
+            task.result((i, pages, tb))
+            task.progress(done + 1, len(filenames))
+
+
+def merge_task(task, first_page, merged):
+    """Merges the (page id, page) pairs in `merged` onto `first_page`,
+    delivering each id once its page is merged.
+    """
+    for i, (page_id, page) in enumerate(merged):
+        first_page.merge(page)
+        task.result(page_id)
+        task.progress(i + 1, len(merged))
 
 
+def overlay_task(task, filename, dpi, targets, tx, ty, op):
+    """Stamps or applies as background the first page of `filename` to the
+    (page id, page) pairs in `targets`, delivering the ids of the pages
+    done.
+    """
+    pages = pdf_pages.load_pages(filename, dpi)
+    if not pages:
+        raise IOError(0, "No pages in <{}>".format(filename))
+    page2 = pages[0]  # Always first page
+    for i, (page_id, page1) in enumerate(targets):
+        page1.merge(page2, tx, ty, op)
+        task.result(page_id)
+        task.progress(i + 1, len(targets))
+
+
+def thumbnails_task(task, cache, jobs):
+    """Renders the (page id, page name, ThumbnailJob) `jobs`, or reads them
+    from `cache`, delivering (page id, page name, PNG data) results. The
+    data is None if the page couldn't be rendered.
+    """
+    for page_id, name, job in jobs:
+        task.check()
+        try:
+            key = job.key()
+            data = cache.get(key)
+            if data is None:
+                data = job.render()
+                cache.put(key, data)
+        except Exception:
+            traceback.print_exc()
+            data = None
+        task.result((page_id, name, data))
+
+
+def index_task(task, index, jobs):
+    """Indexes the files of `jobs`, delivering the (filename, error) pairs
+    of those that couldn't be indexed.
+    """
+    failures = index.run(jobs, progress=task.progress)
+    if failures:
+        task.result(failures)
+
+
+def find_pages_task(task, index, pages, query):
+    """Indexes the pages' files not indexed yet, delivering the rows of the
+    pages matching `query`, and the files that couldn't be indexed.
+    """
+    failures = index.update(pages, progress=task.progress)
+    task.result((index.search(pages, query), failures))
+
+
+def write_single_task(task, pages, filename):
+    # Pages edited from a single document are saved over it as an update.
+    # Other files are written in full, as an update would copy the
+    # document's file, with the pages that were removed
+    source = pages[0].source if pages else None
+    in_place = (source is not None and source.filename is not None and
+                osp.exists(filename) and
+                osp.samefile(filename, source.filename))
+    pdf_pages.write_single(pages, filename, progress=task.progress,
+                           incremental=in_place)
+    task.result(filename)
+
+
+def save_session_task(task, filename, pages, files):
+    session.save_session(filename, pages, files)
+
+
+def load_session_task(task, filename):
+    task.result(session.load_session(filename))
+
+
+def write_multi_task(task, pages, fileprefix):
+    task.result(pdf_pages.write_multi(pages, fileprefix,
+                                      progress=task.progress))
+
+
+def extract_images_task(task, pages, filename, dedup, manifest):
+    task.result(pdf_images.extract_images_parallel(
+        pdf_pages.RenderedPages(pages), filename, dedup=dedup,
+        manifest=manifest, progress=task.progress))
+
+
+#%%
 class WndMain(QtWidgets.QMainWindow):
     ######################
     ### Initialization ###
@@ -191,8 +194,11 @@ class WndMain(QtWidgets.QMainWindow):
                                          QtCore.QSettings.IniFormat)
         # Initialize UI (open main window)
         self.initUI()
-        self.pages = {}
         self.last_file = None
+        self.task = None
+        self.task_recorded = None
+        self.thumbnail_task = None
+        self.index_task = None
 
     def initUI(self):
         ui_file = frozen(osp.join('data', 'wndmain.ui'))
@@ -208,6 +214,51 @@ class WndMain(QtWidgets.QMainWindow):
         self.lineStampY.setValidator(validator)
         self.lineFileDPI.setValidator(validator)
 
+        # Progress of background tasks
+        self.progressTask = QtWidgets.QProgressBar()
+        self.progressTask.setMaximumWidth(200)
+        self.btnTaskCancel = QtWidgets.QPushButton(self.tr("Cancel"))
+        self.btnTaskCancel.clicked.connect(self.cancel_task)
+        self.statusbar.addPermanentWidget(self.progressTask)
+        self.statusbar.addPermanentWidget(self.btnTaskCancel)
+        self.progressTask.hide()
+        self.btnTaskCancel.hide()
+
+        # Thumbnails of the visible pages, rendered in their own thread
+        if thumbnails.available():
+            cache_dir = QtCore.QStandardPaths.writableLocation(
+                QtCore.QStandardPaths.GenericCacheLocation)
+            self.thumbnails = thumbnails.ThumbnailCache(
+                osp.join(cache_dir, 'PyPDFTK', 'thumbnails'))
+        else:
+            self.thumbnails = None
+        self.thumbnail_pool = QtCore.QThreadPool()
+        self.thumbnail_pool.setMaxThreadCount(1)
+        self.thumbnail_timer = QtCore.QTimer()
+        self.thumbnail_timer.setSingleShot(True)
+        self.thumbnail_timer.setInterval(100)
+        self.thumbnail_timer.timeout.connect(self.update_thumbnails)
+        self.listPages.verticalScrollBar().valueChanged.connect(
+            self.thumbnail_timer.start)
+        self.pages = self.listPages.model()
+        if self.thumbnails is not None:
+            placeholder = QtGui.QPixmap(self.listPages.iconSize())
+            placeholder.fill(QtCore.Qt.transparent)
+            self.pages.placeholder_icon = QtGui.QIcon(placeholder)
+        self.pages.rowsInserted.connect(self.thumbnail_timer.start)
+        self.pages.rowsRemoved.connect(self.thumbnail_timer.start)
+        self.pages.layoutChanged.connect(self.thumbnail_timer.start)
+        self.pages.dataChanged.connect(self.thumbnail_timer.start)
+
+        # Text and metadata of the loaded pages, indexed in their own thread
+        self.index_pool = QtCore.QThreadPool()
+        self.index_pool.setMaxThreadCount(1)
+        self.index_timer = QtCore.QTimer()
+        self.index_timer.setSingleShot(True)
+        self.index_timer.setInterval(500)
+        self.index_timer.timeout.connect(self.update_index)
+        self.pages.rowsInserted.connect(self.index_timer.start)
+
         # Load window geometry and state
         self.restoreGeometry(self.settings.value("geometry", b""))
         self.restoreState(self.settings.value("windowState", b""))
@@ -225,35 +276,157 @@ class WndMain(QtWidgets.QMainWindow):
         item.setData(QtCore.Qt.ToolTipRole, filename)
         self.listFiles.addItem(item)
 
-    def load_pages(self, filename):
-        pages = []
+    def file_dpi(self):
         try:
-            image_exts = ['.jpg', '.jpeg', '.bmp', '.gif', '.j2p', '.jpx',
-                          '.png', '.tiff']
-            basefile, ext = osp.splitext(filename.lower())
-            if ext == '.pdf':
-                pages = Page.from_file(filename)
-            elif ext in image_exts:
-                img_size = Image.open(filename).size
-                try:
-                    dpi = float(self.lineFileDPI.text())
-                except:
-                    dpi = float(self.lineFileDPI.placeholderText())
-                img_size = (img_size[0]/dpi*2.54, img_size[1]/dpi*2.54)
-                pages.append(Page.from_image(filename, img_size))
-        except Exception as e:
-            try:
-                errormsg = (self.tr("Could not load <{}>:\n{}")
-                            .format(filename, traceback.format_exc()))
-            except:
-                errormsg = (self.tr("Could not load <{}>:\n{}")
-                            .format(filename, e.message))
-            QtWidgets.QMessageBox.warning(self, self.tr("Error"), errormsg)
-        return pages
+            return float(self.lineFileDPI.text())
+        except:
+            return float(self.lineFileDPI.placeholderText())
+
+    def start_task(self, function, *args, **callbacks):
+        """Runs `function(task, *args)` in the background (see tasks.Task),
+        showing its progress in the status bar, where it can be cancelled.
+        The main window's widgets are disabled until it finishes.
+
+        The `result`, `error` and `finished` keyword arguments are called in
+        the main thread when the task's signals are emitted. By default,
+        errors are shown with their traceback.
+        """
+        # Thumbnails of transformed pages are written from the pages'
+        # documents, which the task may read from
+        if self.thumbnail_task is not None:
+            self.thumbnail_task.cancel()
+            self.thumbnail_pool.waitForDone()
+        task = tasks.Task(function, *args)
+        task.signals.progress.connect(self.on_task_progress)
+        if 'result' in callbacks:
+            task.signals.result.connect(callbacks['result'])
+        task.signals.error.connect(callbacks.get('error', self.on_task_error))
+        task.signals.finished.connect(self.on_task_finished)
+        if 'finished' in callbacks:
+            task.signals.finished.connect(callbacks['finished'])
+        self.task = task
+        # Spans and counters before the task, to show what it did
+        self.task_recorded = profiling.recorded()
+        self.centralWidget().setEnabled(False)
+        self.progressTask.setRange(0, 0)  # Busy until the first progress
+        self.progressTask.show()
+        self.btnTaskCancel.setEnabled(True)
+        self.btnTaskCancel.show()
+        task.start()
+        return task
+
+    def cancel_task(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.btnTaskCancel.setEnabled(False)
+            self.statusbar.showMessage(self.tr("Cancelling..."))
+
+    def on_task_progress(self, done, total):
+        self.progressTask.setRange(0, total)
+        self.progressTask.setValue(done)
+        if self.task is not None and not self.task.cancelled:
+            self.statusbar.showMessage(self.tr("{} of {} done").format(done,
+                                                                       total))
+
+    def on_task_error(self, e, tb):
+        errormsg = self.tr("Error:\n{}").format(tb)
+        QtWidgets.QMessageBox.critical(self, self.tr("Error"), errormsg)
+
+    def on_task_finished(self):
+        self.task = None
+        self.progressTask.hide()
+        self.btnTaskCancel.hide()
+        # Time spent in each stage of the task, and what it loaded or wrote
+        self.statusbar.showMessage(profiling.summary(self.task_recorded))
+        self.centralWidget().setEnabled(True)
+        self.thumbnail_timer.start()
+
+    def visible_page_rows(self):
+        view = self.listPages
+        if view.count() == 0:
+            return range(0)
+        rect = view.viewport().rect()
+        first = view.indexAt(rect.topLeft()).row()
+        last = view.indexAt(rect.bottomLeft()).row()
+        if first < 0:
+            first = 0
+        if last < 0:
+            last = view.count() - 1
+        return range(first, last + 1)
+
+    def update_thumbnails(self):
+        """Renders, in the background, thumbnails of the visible pages
+        whose thumbnail is missing or out of date.
+        """
+        # Jobs for transformed pages read the pages' documents, which tasks
+        # may be reading from
+        if (self.thumbnails is None or self.thumbnail_task is not None or
+                self.task is not None):
+            return
+        jobs = []
+        for row in self.visible_page_rows():
+            if not self.pages.needs_icon(row):
+                continue
+            page = self.pages.page(row)
+            jobs.append((self.pages.page_id(row), page.name,
+                         thumbnails.ThumbnailJob(page)))
+        if not jobs:
+            return
+        task = tasks.Task(thumbnails_task, self.thumbnails, jobs)
+        task.signals.result.connect(self.on_thumbnail_result)
+        task.signals.finished.connect(self.on_thumbnail_finished)
+        self.thumbnail_task = task
+        task.start(self.thumbnail_pool)
+
+    def on_thumbnail_result(self, result):
+        page_id, name, data = result
+        icon = None
+        if data is not None:
+            pixmap = QtGui.QPixmap()
+            pixmap.loadFromData(data, 'PNG')
+            icon = QtGui.QIcon(pixmap)
+        # Also set when rendering failed, so it isn't retried
+        self.pages.set_icon(page_id, name, icon)
+
+    def on_thumbnail_finished(self):
+        self.thumbnail_task = None
+        # Rows may have been scrolled into view meanwhile
+        self.thumbnail_timer.start()
+
+    def update_index(self):
+        """Indexes, in the background, the files of the pages that aren't
+        indexed yet, so that finding pages doesn't have to wait for them.
+        """
+        if self.index_task is not None:
+            return
+        jobs = page_index.index.jobs(self.pages.pages())
+        if not jobs:
+            return
+        task = tasks.Task(index_task, page_index.index, jobs)
+        task.signals.result.connect(self.show_index_failures)
+        task.signals.finished.connect(self.on_index_finished)
+        self.index_task = task
+        task.start(self.index_pool)
+
+    def show_index_failures(self, failures):
+        self.statusbar.showMessage(self.tr("Could not index {}").format(
+            ", ".join("<{}> ({})".format(osp.basename(filename), e)
+                      for filename, e in failures)))
+
+    def on_index_finished(self):
+        self.index_task = None
+        # Pages may have been loaded meanwhile
+        self.index_timer.start()
+
+    def show_io_error(self, e, tb):
+        if not isinstance(e, IOError):
+            return self.on_task_error(e, tb)
+        errmsg = self.tr("I/O error({0}): {1}\n"
+            "Please check if the file is open in another program."
+            ).format(e.errno, e.strerror)
+        QtWidgets.QMessageBox.critical(self, self.tr("Error"), errmsg)
 
     def on_listFiles_dropped(self, links):
-        print("filesDropped:", links)
-
         for link in links:
             self.open_file(link)
 
@@ -331,30 +504,35 @@ class WndMain(QtWidgets.QMainWindow):
             self.listFiles.setCurrentRow(last-row, QtCore.QItemSelectionModel.Select)
 
     def load_pages_from_rows(self, rows):
-        pitems = []
-        try:
-            if self.radioFileLoadSelBef.isChecked():
-                to_row = self.listPages.row(self.listPages.selectedItems()[0])
-            elif self.radioFileLoadSelAft.isChecked():
-                to_row = self.listPages.row(self.listPages.selectedItems()[-1])+1
-            else:
-                to_row = self.listPages.count()
-        except:
+        """Loads the files in `rows` in the background, inserting and
+        selecting their pages as each file is loaded.
+        """
+        selected_rows = self.listPages.selected_rows()
+        if self.radioFileLoadSelBef.isChecked() and selected_rows:
+            to_row = selected_rows[0]
+        elif self.radioFileLoadSelAft.isChecked() and selected_rows:
+            to_row = selected_rows[-1] + 1
+        else:
             to_row = self.listPages.count()
-        for fitem in [self.listFiles.item(row) for row in rows]:
-            filename = fitem.data(QtCore.Qt.ToolTipRole)
-            pages = self.load_pages(filename)
-            for page in pages:
-                self.pages[page.uuid] = page
-                pitem = QtWidgets.QListWidgetItem(page.name)
-                pitem.setData(QtCore.Qt.UserRole, page.uuid)
-                if self.radioFileLoadEnd.isChecked():
-                    self.listPages.addItem(pitem)
-                else:
-                    self.listPages.insertItem(to_row, pitem)
-                    to_row += 1
-                pitems.append(pitem)
-        return pitems
+        filenames = [self.listFiles.item(row).data(QtCore.Qt.ToolTipRole)
+                     for row in rows]
+        self.listPages.selectionModel().clear()
+        # Files finish loading in any order, so each file's pages go after
+        # the pages of the files before it that were already loaded
+        counts = [0] * len(filenames)
+
+        def loaded(result):
+            index, pages, tb = result
+            if tb is not None:
+                errormsg = (self.tr("Could not load <{}>:\n{}")
+                            .format(filenames[index], tb))
+                QtWidgets.QMessageBox.warning(self, self.tr("Error"), errormsg)
+            rows = self.pages.insert_pages(to_row + sum(counts[:index]), pages)
+            self.listPages.select_rows(rows, clear=False)
+            counts[index] = len(pages)
+
+        self.start_task(load_files_task, filenames, self.file_dpi(),
+                        result=loaded)
 
 
     @QtCore.Slot()
@@ -362,19 +540,13 @@ class WndMain(QtWidgets.QMainWindow):
         # sort by row, otherwise it's selection order
         rows = [self.listFiles.row(item) for item in self.listFiles.selectedItems()]
         rows.sort()
-        pitems = self.load_pages_from_rows(rows)
-        self.listPages.selectionModel().clear()
-        for item in pitems:
-            item.setSelected(True)
+        self.load_pages_from_rows(rows)
 
 
     @QtCore.Slot()
     def on_btnFileLoadAll_clicked(self):
         rows = range(self.listFiles.count())
-        pitems = self.load_pages_from_rows(rows)
-        self.listPages.selectionModel().clear()
-        for item in pitems:
-            item.setSelected(True)
+        self.load_pages_from_rows(rows)
 
     @QtCore.Slot()
     def on_btnFileSortAsc_clicked(self):
@@ -396,116 +568,77 @@ class WndMain(QtWidgets.QMainWindow):
 
     @QtCore.Slot()
     def on_btnPageRem_clicked(self):
-        for item in self.listPages.selectedItems():
-            page_uuid = item.data(QtCore.Qt.UserRole)
-            del self.pages[page_uuid]
-            self.listPages.takeItem(self.listPages.row(item))
+        self.pages.remove_rows(self.listPages.selected_rows())
 
     @QtCore.Slot()
     def on_btnPageClear_clicked(self):
-        self.listPages.clear()
-        self.pages = {}
+        self.pages.clear()
 
     @QtCore.Slot()
     def on_btnPageSortAsc_clicked(self):
-        self.listPages.sortItems(QtCore.Qt.AscendingOrder)
+        self.pages.sort(0, QtCore.Qt.AscendingOrder)
 
     @QtCore.Slot()
     def on_btnPageSortDesc_clicked(self):
-        self.listPages.sortItems(QtCore.Qt.DescendingOrder)
+        self.pages.sort(0, QtCore.Qt.DescendingOrder)
 
     @QtCore.Slot()
     def on_btnPageTop_clicked(self):
-        rows = [self.listPages.row(item) for item in self.listPages.selectedItems()]
-        rows.sort(reverse=True)
-        for item in [self.listPages.item(row) for row in rows]:
-            row = self.listPages.row(item)
-            self.listPages.insertItem(0, self.listPages.takeItem(row))
-            item.setSelected(True)
+        rows = self.pages.move_rows(self.listPages.selected_rows(), 0)
+        self.listPages.select_rows(rows)
 
     @QtCore.Slot()
     def on_btnPageUp_clicked(self):
-        rows = [self.listPages.row(item) for item in self.listPages.selectedItems()]
-        rows.sort()
-        # Ignore rows already on top
-        first_rows = []
-        first_row = 0
-        for row in rows[:]:
-            if row == first_row:
-                first_rows.append(row)
-                rows.remove(row)
-                first_row += 1
-        for item in [self.listPages.item(row) for row in rows]:
-            row = self.listPages.row(item)
-            self.listPages.insertItem(row-1, self.listPages.takeItem(row))
-            item.setSelected(True)
+        rows = self.pages.shift_rows(self.listPages.selected_rows(), up=True)
+        self.listPages.select_rows(rows)
 
     @QtCore.Slot()
     def on_btnPageDown_clicked(self):
-        rows = [self.listPages.row(item) for item in self.listPages.selectedItems()]
-        rows.sort(reverse=True)
-        # Ignore rows already on top
-        last_rows = []
-        last_row = self.listPages.count() - 1
-        for row in rows[:]:
-            if row == last_row:
-                last_rows.append(row)
-                rows.remove(row)
-                last_row -= 1
-        for item in [self.listPages.item(row) for row in rows]:
-            row = self.listPages.row(item)
-            self.listPages.insertItem(row+1, self.listPages.takeItem(row))
-            item.setSelected(True)
+        rows = self.pages.shift_rows(self.listPages.selected_rows(), up=False)
+        self.listPages.select_rows(rows)
 
     @QtCore.Slot()
     def on_btnPageBottom_clicked(self):
-        rows = [self.listPages.row(item) for item in self.listPages.selectedItems()]
-        rows.sort()
-        last = self.listPages.count() - 1
-        for item in [self.listPages.item(row) for row in rows]:
-            row = self.listPages.row(item)
-            self.listPages.insertItem(last, self.listPages.takeItem(row))
-            item.setSelected(True)
+        rows = self.pages.move_rows(self.listPages.selected_rows(),
+                                    self.pages.rowCount())
+        self.listPages.select_rows(rows)
 
     @QtCore.Slot()
     def on_btnPageRotLeft_clicked(self):
-        for item in self.listPages.selectedItems():
-            page_uuid = item.data(QtCore.Qt.UserRole)
-            page = self.pages[page_uuid]
+        rows = self.listPages.selected_rows()
+        for page in self.pages.pages(rows):
             page.rotateLeft()
-            item.setText(page.name)
+        self.pages.pages_changed(rows)
 
     @QtCore.Slot()
     def on_btnPageRotRight_clicked(self):
-        for item in self.listPages.selectedItems():
-            page_uuid = item.data(QtCore.Qt.UserRole)
-            page = self.pages[page_uuid]
+        rows = self.listPages.selected_rows()
+        for page in self.pages.pages(rows):
             page.rotateRight()
-            item.setText(page.name)
+        self.pages.pages_changed(rows)
 
     @QtCore.Slot()
     def on_btnPageMerge_clicked(self):
-        rows = [self.listPages.row(item) for item in self.listPages.selectedItems()]
-        rows.sort()
+        rows = self.listPages.selected_rows()
         if len(rows)<2:
             QtWidgets.QMessageBox.warning(self, self.tr("Warning"),
                                        self.tr("You must select at least "
                                                "two pages to merge."))
             return
-        first_item = self.listPages.item(rows[0])
-        variant = first_item.data(QtCore.Qt.UserRole)
-        first_page = self.pages[variant]
-        for item in [self.listPages.item(row) for row in rows[1:]]:
-            row = self.listPages.row(item)
-            merged_page_uuid = item.data(QtCore.Qt.UserRole)
-            first_page.merge(self.pages[merged_page_uuid])
-            del self.pages[merged_page_uuid]
-            self.listPages.takeItem(row)
-            first_item.setText(first_page.name)
+        first_id = self.pages.page_id(rows[0])
+        first_page = self.pages.page(rows[0])
+        merged = [(self.pages.page_id(row), self.pages.page(row))
+                  for row in rows[1:]]
+
+        def merged_page(page_id):
+            self.pages.remove_rows([self.pages.row(page_id)])
+            self.pages.pages_changed([self.pages.row(first_id)])
+
+        self.start_task(merge_task, first_page, merged, result=merged_page)
 
     @QtCore.Slot()
     def on_btnPageStamp_clicked(self):
-        if len(self.listPages.selectedItems()) == 0:
+        if not self.listPages.selectionModel().hasSelection():
             QtWidgets.QMessageBox.warning(self, self.tr("Warning"),
                                        self.tr("You must select at least "
                                                "one page to stamp."))
@@ -526,16 +659,12 @@ class WndMain(QtWidgets.QMainWindow):
                                                      self.tr('Open file'),
                                                      "",
                                                      self.supported_files)[0]
-        page2 = self.load_pages(filename)[0]  # Always first page
-        sys.stdout.flush()
-        for item in self.listPages.selectedItems():
-            page1 = self.pages[item.data(QtCore.Qt.UserRole)]
-            page1.merge(page2, tx*mult, ty*mult, "stamp")
-            item.setText(page1.name)
+        if filename:
+            self.apply_overlay(filename, tx*mult, ty*mult, "stamp")
 
     @QtCore.Slot()
     def on_btnPageBackground_clicked(self):
-        if len(self.listPages.selectedItems()) == 0:
+        if not self.listPages.selectionModel().hasSelection():
             QtWidgets.QMessageBox.warning(self, self.tr("Warning"),
                                        self.tr("You must select at least "
                                                "one page to apply background."))
@@ -560,16 +689,63 @@ class WndMain(QtWidgets.QMainWindow):
                                                      self.tr('Open file'),
                                                      "",
                                                      self.supported_files)[0]
-        page2 = self.load_pages(filename)[0]  # Always first page
-        for item in self.listPages.selectedItems():
-            page1 = self.pages[item.data(QtCore.Qt.UserRole)]
-            page1.merge(page2, tx*mult, ty*mult, "background")
-            item.setText(page1.name)
+        if filename:
+            self.apply_overlay(filename, tx*mult, ty*mult, "background")
+
+    def apply_overlay(self, filename, tx, ty, op):
+        """Stamps or applies as background the first page of `filename` to
+        the selected pages, in the background.
+        """
+        targets = [(self.pages.page_id(row), self.pages.page(row))
+                   for row in self.listPages.selected_rows()]
+
+        def merged(page_id):
+            self.pages.pages_changed([self.pages.row(page_id)])
+
+        self.start_task(overlay_task, filename, self.file_dpi(), targets,
+                        tx, ty, op, result=merged)
 
     @QtCore.Slot()
     def on_btnPageSelectAll_clicked(self):
         self.listPages.selectAll()
 
+    @QtCore.Slot()
+    def on_btnPageFind_clicked(self):
+        query = self.lineFind.text()
+        try:
+            page_index.parse_query(query)
+        except ValueError as e:
+            QtWidgets.QMessageBox.warning(self, self.tr("Error"),
+                self.tr("Invalid query: {}").format(e))
+            return
+        # The search indexes what's left itself
+        if self.index_task is not None:
+            self.index_task.cancel()
+        found = []
+        failed = []
+
+        def matched(result):
+            rows, failures = result
+            found[:] = rows
+            failed[:] = failures
+            self.listPages.select_rows(rows)
+            if rows:
+                self.listPages.scrollTo(self.pages.index(rows[0]))
+
+        def finished():
+            if failed:
+                self.show_index_failures(failed)
+            else:
+                self.statusbar.showMessage(
+                    self.tr("{} pages found").format(len(found)))
+
+        self.start_task(find_pages_task, page_index.index, self.pages.pages(),
+                        query, result=matched, finished=finished)
+
+    @QtCore.Slot()
+    def on_lineFind_returnPressed(self):
+        self.on_btnPageFind_clicked()
+
     @QtCore.Slot()
     def on_btnWriteSingle_clicked(self):
         if self.listPages.count() == 0:
@@ -592,21 +768,14 @@ class WndMain(QtWidgets.QMainWindow):
         if filename:
             filename = filename.replace("/", osp.sep)
             self.last_file = filename
-            output_pdf = pdf.PdfFileWriter()
-            rows = range(self.listPages.count())
-            for item in [self.listPages.item(row) for row in rows]:
-                page_uuid = item.data(QtCore.Qt.UserRole)
-                output_pdf.addPage(self.pages[page_uuid].obj)
-            try:
-                with open(filename, 'wb') as f:
-                    output_pdf.write(f)
+            pages = self.pages.pages()
+
+            def written(filename):
                 if self.chkOpenOnSave.isChecked():
                     open_default_program(filename)
-            except IOError as e:
-                errmsg = self.tr("I/O error({0}): {1}\n"
-                    "Please check if the file is open in another program."
-                    ).format(e.errno, e.strerror)
-                QtWidgets.QMessageBox.critical(self, self.tr("Error"), errmsg)
+
+            self.start_task(write_single_task, pages, filename,
+                            result=written, error=self.show_io_error)
 
     @QtCore.Slot()
     def on_btnWriteMulti_clicked(self):
@@ -622,25 +791,23 @@ class WndMain(QtWidgets.QMainWindow):
         if filename:
             filename = filename.replace("/", osp.sep)
             fileprefix = osp.splitext(filename)[0]
-            rows = range(self.listPages.count())
-            # pre-check filenames to see if we're overwriting something
-            for i in rows:
-                filename_i = "{}{:04}.pdf".format(fileprefix, i)
-                if osp.exists(filename_i):
-                    errmsg = self.tr("File {} already exists!\nWe don't want "
-                        "to overwrite it. Aborting.").format(filename_i)
-                    QtWidgets.QMessageBox.critical(self, self.tr("Error"),
-                                               errmsg)
-                    return
-            for i, item in enumerate([self.listPages.item(row) for row in rows]):
-                filename_i = "{}{:04}.pdf".format(fileprefix, i)
-                output_pdf = pdf.PdfFileWriter()
-                page_uuid = item.data(QtCore.Qt.UserRole)
-                output_pdf.addPage(self.pages[page_uuid].obj)
-                with open(filename_i, 'wb') as f:
-                    output_pdf.write(f)
+            pages = self.pages.pages()
+
+            def written(filenames):
                 if self.chkOpenOnSave.isChecked():
-                    open_default_program(filename_i)
+                    for filename_i in filenames:
+                        open_default_program(filename_i)
+
+            def failed(e, tb):
+                if not isinstance(e, FileExistsError):
+                    return self.show_io_error(e, tb)
+                errmsg = self.tr("File {} already exists!\nWe don't want "
+                    "to overwrite it. Aborting.").format(e.args[0])
+                QtWidgets.QMessageBox.critical(self, self.tr("Error"),
+                                           errmsg)
+
+            self.start_task(write_multi_task, pages, fileprefix,
+                            result=written, error=failed)
 
     @QtCore.Slot()
     def on_btnExtractImages_clicked(self):
@@ -659,21 +826,65 @@ class WndMain(QtWidgets.QMainWindow):
                                                      filename,
                                                      supported_files)[0]
         if filename:
-            fileprefix, ext = osp.splitext(filename)
-            rows = range(self.listPages.count())
-            i = 0
-            for row, item in [(row, self.listPages.item(row)) for row in rows]:
-                page_uuid = item.data(QtCore.Qt.UserRole)
-                try:
-                    i = pdf_images.extract_images(self.pages[page_uuid].obj, filename, i)
-                except:
+            pages = self.pages.pages()
+            dedup = self.chkExtractDedup.isChecked()
+            manifest = filename + 'manifest.json' if dedup else None
+
+            def extracted(result):
+                i, failed_pages = result
+                if failed_pages:
                     QtWidgets.QMessageBox.critical(self, self.tr("Error"),
                         self.tr("There was a problem extracting images from "
-                                "page {}.<br>Please file a bug report, "
+                                "page(s) {}.<br>Please file a bug report, "
                                 "attaching the problematic file if possible, in <br>"
                                 "<a href='https://github.com/ronanpaixao/PyPDFTK/issues'>"
                                 "https://github.com/ronanpaixao/PyPDFTK/issues"
-                                "</a>".format(row + 1)))
+                                "</a>".format(", ".join(str(page_number + 1)
+                                                        for page_number in failed_pages))))
+
+            self.start_task(extract_images_task, pages, filename, dedup,
+                            manifest, result=extracted,
+                            error=self.show_io_error)
+
+    @QtCore.Slot()
+    def on_btnSessionSave_clicked(self):
+        supported_files = self.tr("PyPDFTK session (*{})").format(
+            session.extension)
+        filename = QtWidgets.QFileDialog.getSaveFileName(self,
+                                                     self.tr('Save session'),
+                                                     "", supported_files)[0]
+        if filename:
+            filename = filename.replace("/", osp.sep)
+            files = [self.listFiles.item(row).data(QtCore.Qt.ToolTipRole)
+                     for row in range(self.listFiles.count())]
+            self.start_task(save_session_task, filename, self.pages.pages(),
+                            files, error=self.show_io_error)
+
+    @QtCore.Slot()
+    def on_btnSessionOpen_clicked(self):
+        supported_files = self.tr("PyPDFTK session (*{})").format(
+            session.extension)
+        filename = QtWidgets.QFileDialog.getOpenFileName(self,
+                                                     self.tr('Open session'),
+                                                     "", supported_files)[0]
+        if filename:
+            def loaded(result):
+                pages, files = result
+                self.listFiles.clear()
+                for path in files:
+                    self.open_file(path)
+                self.pages.clear()
+                self.pages.insert_pages(0, pages)
+
+            def failed(e, tb):
+                if isinstance(e, ValueError):
+                    QtWidgets.QMessageBox.critical(self, self.tr("Error"),
+                        self.tr("Could not open the session:\n{}").format(e))
+                else:
+                    self.show_io_error(e, tb)
+
+            self.start_task(load_session_task, filename, result=loaded,
+                            error=failed)
 
     @QtCore.Slot()
     def on_btnCredits_clicked(self):
@@ -684,14 +895,27 @@ class WndMain(QtWidgets.QMainWindow):
 
     ### Method overrides:
     def closeEvent(self, e):
+        # Stop the running task, so it doesn't outlive the window
+        self.cancel_task()
+        if self.thumbnail_task is not None:
+            self.thumbnail_task.cancel()
+        if self.index_task is not None:
+            self.index_task.cancel()
+        QtCore.QThreadPool.globalInstance().waitForDone()
+        self.thumbnail_pool.waitForDone()
+        self.index_pool.waitForDone()
         # Write window geometry and state to config file
         self.settings.setValue("geometry", self.saveGeometry())
         self.settings.setValue("windowState", self.saveState())
+        if os.environ.get('PYPDFTK_PROFILE_REPORT'):
+            profiling.write_report(os.environ['PYPDFTK_PROFILE_REPORT'])
         e.accept()
 
 
 #%%
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    profiling.enable_from_environment()
     myappid = u'br.com.dapaixao.pypdftk.1.0'
     ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
     existing = QtWidgets.qApp.instance()
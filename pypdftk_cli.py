@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Headless command line interface to the page pipeline. This module must not
+import Qt, so it can run on servers without a display.
+
+Examples:
+    pypdftk_cli.py a.pdf b.jpg --write-single out.pdf
+    pypdftk_cli.py a.pdf --pages 3,1-2 --rotate right --write-multi page_
+    pypdftk_cli.py a.pdf --stamp logo.pdf --offset 1 2 --write-single out.pdf
+    pypdftk_cli.py a.pdf --select 3 --rotate right --write-single a.pdf --incremental
+    pypdftk_cli.py a.pdf --extract-images a_IMG_
+    pypdftk_cli.py scans.pdf --split-at INVOICE --write-multi invoice_
+    pypdftk_cli.py a.pdf b.pdf --where "landscape file:b.pdf" --write-single out.pdf
+    pypdftk_cli.py a.pdf --select-where "-images>0" --stamp draft.pdf --write-single out.pdf
+    pypdftk_cli.py scans/ --dpi 300 --write-single scans.pdf
+    pypdftk_cli.py a.pdf b.pdf --rotate right --save-session job.pypdftk
+    pypdftk_cli.py job.pypdftk --write-single out.pdf
+    pypdftk_cli.py a.pdf --write-single out.pdf --profile-report report.json
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import os
+import os.path as osp
+import sys
+import argparse
+import multiprocessing
+from decimal import Decimal
+
+import page_index
+import pdf_images
+import pdf_pages
+import profiling
+import session
+
+
+def parse_page_ranges(text, count):
+    """Parses 1-based page ranges such as "1-3,7,10-" into 0-based indexes,
+    in the given order. Open ranges extend to the first or last page, and
+    descending ranges ("5-1") are allowed.
+    """
+    indexes = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            first = int(first) if first.strip() else 1
+            last = int(last) if last.strip() else count
+        else:
+            first = last = int(part)
+        for number in (first, last):
+            if not 1 <= number <= count:
+                raise ValueError("page {} out of range 1-{}".format(number,
+                                                                   count))
+        step = 1 if last >= first else -1
+        indexes.extend(range(first - 1, last - 1 + step, step))
+    return indexes
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='pypdftk',
+        description="The Python PDF ToolKit, headless. Loads the inputs, "
+                    "applies merge, rotate, stamp and background (in that "
+                    "order) to the selected pages and writes the result.")
+    parser.add_argument('inputs', nargs='+', metavar='FILE',
+                        help="PDF or image files, loaded in order, "
+                             "sessions (*{}), whose pages are restored with "
+                             "their operations, or directories, whose PDF "
+                             "and image files are loaded in name "
+                             "order".format(session.extension))
+    parser.add_argument('--dpi', type=float, default=72.,
+                        help="resolution used to size image pages "
+                             "(default: %(default)s)")
+    parser.add_argument('--pages', metavar='RANGES',
+                        help="pages to keep, in order, e.g. 3,1-2,10- "
+                             "(default: all)")
+    parser.add_argument('--where', metavar='QUERY',
+                        help="keep only the pages, after --pages, matching "
+                             "QUERY, e.g. 'INVOICE landscape file:a*.pdf' "
+                             "(see page_index)")
+    select = parser.add_mutually_exclusive_group()
+    select.add_argument('--select', metavar='RANGES',
+                        help="pages, numbered after --pages and --where, to "
+                             "which the operations apply (default: all)")
+    select.add_argument('--select-where', metavar='QUERY',
+                        help="apply the operations to the pages matching "
+                             "QUERY")
+    parser.add_argument('--merge', action='store_true',
+                        help="superpose the selected pages onto the first "
+                             "selected page")
+    parser.add_argument('--rotate', choices=['left', 'right', '180'],
+                        help="rotate the selected pages")
+    parser.add_argument('--stamp', metavar='FILE',
+                        help="stamp the first page of FILE onto the selected "
+                             "pages")
+    parser.add_argument('--offset', nargs=2, type=Decimal, default=None,
+                        metavar=('X', 'Y'), help="stamp location")
+    parser.add_argument('--background', metavar='FILE',
+                        help="place the first page of FILE behind the "
+                             "selected pages")
+    parser.add_argument('--background-offset', nargs=2, type=Decimal,
+                        default=None, metavar=('X', 'Y'),
+                        help="background location")
+    parser.add_argument('--units', choices=['cm', 'in'], default='cm',
+                        help="units of the offsets (default: %(default)s)")
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--write-single', metavar='OUTPUT',
+                        help="write all pages to a single PDF")
+    output.add_argument('--write-multi', metavar='PREFIX',
+                        help="write each page to PREFIX0000.pdf, "
+                             "PREFIX0001.pdf, ...")
+    output.add_argument('--extract-images', metavar='PREFIX',
+                        help="extract the images in the pages to "
+                             "PREFIX0000.xxx, PREFIX0001.xxx, ...")
+    output.add_argument('--save-session', metavar='FILE',
+                        help="save the pages and their operations to a "
+                             "session file, to be written later")
+    parser.add_argument('--split-at', metavar='QUERY',
+                        help="with --write-multi, start a new file at each "
+                             "page matching QUERY, instead of writing a file "
+                             "per page")
+    parser.add_argument('--incremental', action='store_true',
+                        help="with --write-single, when all pages come from "
+                             "one PDF, write it as that PDF plus an "
+                             "incremental update with only the changed "
+                             "pages (appended to it, if it's the output)")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="number of processes used to convert images to "
+                             "PDF and to extract images (default: number of "
+                             "CPUs)")
+    parser.add_argument('--dedup', action='store_true',
+                        help="extract images used more than once (same "
+                             "object or same content) only once")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="write a JSON (or CSV, for *.csv) manifest "
+                             "mapping each page's images to the extracted "
+                             "files")
+    parser.add_argument('--profile', action='append', default=[],
+                        choices=profiling.capture_modes,
+                        help="capture a cProfile profile or tracemalloc "
+                             "allocations in the report (also set by the "
+                             "PYPDFTK_PROFILE environment variable)")
+    parser.add_argument('--profile-report', metavar='FILE',
+                        default=os.environ.get('PYPDFTK_PROFILE_REPORT'),
+                        help="write the time spent in each stage, counters "
+                             "and any capture to FILE, as JSON")
+    return parser
+
+
+def expand_inputs(inputs):
+    """Replaces directories in `inputs` by the PDF and image files in them,
+    sorted by name.
+    """
+    filenames = []
+    for name in inputs:
+        if osp.isdir(name):
+            filenames.extend(
+                osp.join(name, entry) for entry in sorted(os.listdir(name))
+                if entry.lower().endswith('.pdf') or
+                pdf_pages.is_image(entry))
+        else:
+            filenames.append(name)
+    return filenames
+
+
+def update_index(pages, processes):
+    for filename, e in page_index.index.update(pages, processes):
+        print("Could not index <{}>: {}".format(filename, e),
+              file=sys.stderr)
+
+
+def load_overlay(filename, dpi):
+    pages = pdf_pages.load_pages(filename, dpi)
+    if not pages:
+        raise ValueError("no pages in <{}>".format(filename))
+    return pages[0]  # Always first page
+
+
+def run(args):
+    inputs = expand_inputs(args.inputs)
+    loaded = [None] * len(inputs)
+    files = [i for i, filename in enumerate(inputs)
+             if not session.is_session(filename)]
+    for i, filename in enumerate(inputs):
+        if session.is_session(filename):
+            loaded[i] = session.load_session(filename)[0]
+    for i, file_pages, error in pdf_pages.load_files(
+            [inputs[i] for i in files], args.dpi, processes=args.jobs):
+        if error is not None:
+            raise error
+        if not file_pages:
+            raise ValueError("unsupported file <{}>".format(inputs[files[i]]))
+        loaded[files[i]] = file_pages
+    pages = [page for file_pages in loaded for page in file_pages]
+
+    if args.pages:
+        pages = [pages[i] for i in parse_page_ranges(args.pages, len(pages))]
+    if args.where or args.select_where or args.split_at:
+        update_index(pages, args.jobs)
+    if args.where:
+        pages = [pages[i] for i in page_index.index.search(pages, args.where)]
+    if args.select:
+        selected = sorted(set(parse_page_ranges(args.select, len(pages))))
+    elif args.select_where:
+        selected = page_index.index.search(pages, args.select_where)
+    else:
+        selected = list(range(len(pages)))
+
+    # 1 PDF unit = 1/72 inches
+    if args.units == 'cm':
+        mult = 72/Decimal(2.54)
+    else:
+        mult = 72/Decimal(1.0)
+
+    if args.merge and len(selected) > 1:
+        first_page = pages[selected[0]]
+        for i in selected[1:]:
+            first_page.merge(pages[i])
+        merged = set(selected[1:])
+        pages = [page for i, page in enumerate(pages) if i not in merged]
+        selected = selected[:1]
+    selected_pages = [pages[i] for i in selected]
+
+    for page in selected_pages:
+        if args.rotate == 'left':
+            page.rotateLeft()
+        elif args.rotate == 'right':
+            page.rotateRight()
+        elif args.rotate == '180':
+            page.rotateRight()
+            page.rotateRight()
+    if args.stamp:
+        page2 = load_overlay(args.stamp, args.dpi)
+        tx, ty = args.offset or (Decimal(0), Decimal(0))
+        for page in selected_pages:
+            page.merge(page2, tx*mult, ty*mult, "stamp")
+    if args.background:
+        page2 = load_overlay(args.background, args.dpi)
+        tx, ty = args.background_offset or (Decimal(0), Decimal(0))
+        for page in selected_pages:
+            page.merge(page2, tx*mult, ty*mult, "background")
+
+    if args.write_single:
+        pdf_pages.write_single(pages, args.write_single,
+                               incremental=args.incremental)
+        print("Wrote {} pages to {}".format(len(pages), args.write_single))
+    elif args.write_multi:
+        groups = None
+        if args.split_at:
+            # Stamps and backgrounds are indexed too
+            update_index(pages, args.jobs)
+            groups = page_index.split_at(
+                len(pages), page_index.index.search(pages, args.split_at))
+        filenames = pdf_pages.write_multi(pages, args.write_multi,
+                                          groups=groups)
+        print("Wrote {} files".format(len(filenames)))
+    elif args.save_session:
+        session.save_session(args.save_session, pages,
+                             [inputs[i] for i in files])
+        print("Saved {} pages to {}".format(len(pages), args.save_session))
+    elif args.extract_images:
+        i, failed_pages = pdf_images.extract_images_parallel(
+            pdf_pages.RenderedPages(pages), args.extract_images,
+            processes=args.jobs, dedup=args.dedup, manifest=args.manifest)
+        print("Extracted {} images".format(i))
+        for page_number in failed_pages:
+            print("There was a problem extracting images from page "
+                  "{}.".format(page_number + 1), file=sys.stderr)
+        if failed_pages:
+            return 1
+    return 0
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    profiling.enable_from_environment()
+    profiling.enable(args.profile)
+    try:
+        with profiling.profiled():
+            return run(args)
+    except FileExistsError as e:
+        print("File {} already exists! We don't want to overwrite it. "
+              "Aborting.".format(e.args[0]), file=sys.stderr)
+    except (IOError, ValueError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+    finally:
+        if args.profile_report:
+            profiling.write_report(args.profile_report)
+            print(profiling.summary(), file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
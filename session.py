@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Session files, saving the page arrangement (the source files, the page
+order and each page's operations) so that it can be reopened later, or
+handed to the command line interface. This module must not import Qt.
+
+Sessions are compact JSON:
+    {"version": 1,
+     "files": [path, ...],  # The file list
+     "sources": [{"path": ..., "size": ..., "mtime": ..., "sha1": ...,
+                  "page_size_cm": [w, h], "frame": n or null},  # Images only
+                 ...],
+     "states": [[source, page number, [op, ...]], ...],
+     "pages": [state, ...]}
+Each state is a page with its operations, ["rotate", +/-90] or
+[op, state, tx, ty] for merges, stamps and backgrounds, where the state is
+the merged page, listed before. Pages stamped on many others are listed
+once. Paths are relative to the session file, when possible.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import os.path as osp
+import json
+import hashlib
+
+import pdf_pages
+import pdf_sources
+
+
+extension = '.pypdftk'
+version = 1
+
+
+def is_session(filename):
+    return filename.lower().endswith(extension)
+
+
+def _relpath(path, start):
+    try:
+        return osp.relpath(path, start)
+    except ValueError:  # Another drive, on Windows
+        return osp.abspath(path)
+
+
+def _states(pages):
+    """Returns the documents `pages` come from, and the states (see the
+    module's documentation) and the page list, referencing them by index.
+    """
+    sources = []
+    source_index = {}
+    states = []
+    state_index = {}
+
+    def source_entry(source):
+        index = source_index.get(id(source))
+        if index is None:
+            index = source_index[id(source)] = len(sources)
+            sources.append(source)
+        return index
+
+    def state_entry(page, shared):
+        if shared and id(page) in state_index:
+            return state_index[id(page)]
+        ops = []
+        for op in page.ops:
+            if op[0] == 'rotate':
+                ops.append(list(op))
+            else:
+                # Merged pages are snapshots, shared by all the pages they
+                # were merged with
+                ops.append([op[0], state_entry(op[1], True), float(op[2]),
+                            float(op[3])])
+        index = len(states)
+        states.append([source_entry(page.source), page.page_number, ops])
+        if shared:
+            state_index[id(page)] = index
+        return index
+
+    page_states = [state_entry(page, False) for page in pages]
+    return sources, states, page_states
+
+
+def _source_entry(source, path):
+    entry = {'path': path}
+    if source.image is not None:
+        entry['page_size_cm'] = list(source.image[0])
+        entry['frame'] = source.image[1]
+    return entry
+
+
+def _changed(source):
+    """Tells if a document can't be read again from its file as it was
+    loaded: it wasn't loaded from a file, or the file changed since (e.g.
+    by an incremental update, or by writing over it).
+    """
+    if source.image is not None:
+        return False
+    if source.changed:
+        return True
+    try:
+        fingerprint = pdf_sources.DocumentCache.fingerprint(source.filename)
+    except OSError:
+        return True
+    return fingerprint != source.fingerprint
+
+
+def save_session(filename, pages, files=()):
+    """Saves `pages`, and the list of `files`, to a session file.
+
+    Raises ValueError if a page's source file changed since it was loaded,
+    as the session couldn't recreate its pages from the file.
+    """
+    start = osp.dirname(osp.abspath(filename))
+    sources, states, page_states = _states(pages)
+    entries = []
+    for source in sources:
+        if _changed(source):
+            raise ValueError("source file <{}> changed since it was loaded; "
+                             "reload it before saving the session".format(
+                                 source.origin))
+        path = source.filename or source.origin
+        stat = pdf_sources.DocumentCache.fingerprint(path)
+        entry = _source_entry(source, _relpath(path, start))
+        entry.update({'mtime': stat[1], 'size': stat[2],
+                      'sha1': source.digest})
+        entries.append(entry)
+    session = {'version': version,
+               'files': [_relpath(path, start) for path in files],
+               'sources': entries,
+               'states': states,
+               'pages': page_states}
+    with open(filename, 'w') as f:
+        json.dump(session, f, separators=(',', ':'))
+
+
+def describe(pages):
+    """Describes `pages` as a session does, with absolute paths, so that
+    they can be recreated in another process (see `restore`). Returns None
+    if a document can't be read again from its file as it was loaded: it
+    wasn't loaded from a file, or the file changed since.
+    """
+    sources, states, page_states = _states(pages)
+    entries = []
+    for source in sources:
+        if _changed(source):
+            return None
+        entries.append(_source_entry(
+            source, osp.abspath(source.filename or source.origin)))
+    return {'sources': entries, 'states': states, 'pages': page_states}
+
+
+def restore(description):
+    """Recreates the pages described by `describe`."""
+    return _restore(description,
+                    [entry['path'] for entry in description['sources']])
+
+
+def _digest(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _check_source(entry, path):
+    """Raises ValueError if a source file isn't the one the session was
+    saved with. Files with another modification time, e.g. copied, are
+    only accepted if their contents are the same.
+    """
+    if not osp.exists(path):
+        raise ValueError("source file <{}> not found".format(path))
+    stat = pdf_sources.DocumentCache.fingerprint(path)
+    if stat[2] != entry['size'] or (stat[1] != entry['mtime'] and
+                                    _digest(path) != entry['sha1']):
+        raise ValueError("source file <{}> changed since the session was "
+                         "saved".format(path))
+
+
+def load_session(filename):
+    """Loads a session file, returning its pages and its list of files.
+
+    Pages are recreated from their source files and operations, without
+    loading every page of the files: documents are only parsed up to their
+    cross-reference table, and images are converted when first read.
+    """
+    start = osp.dirname(osp.abspath(filename))
+    with open(filename) as f:
+        session = json.load(f)
+    if session.get('version') != version:
+        raise ValueError("unsupported session version {}".format(
+            session.get('version')))
+
+    paths = []
+    for entry in session['sources']:
+        path = osp.normpath(osp.join(start, entry['path']))
+        _check_source(entry, path)
+        paths.append(path)
+
+    pages = _restore(session, paths)
+    files = [osp.normpath(osp.join(start, path))
+             for path in session['files']]
+    return pages, files
+
+
+def _restore(session, paths):
+    """Recreates the pages of a session, or of a description, whose
+    sources are in the files `paths`.
+    """
+    documents = {}
+
+    def new_page(source, page_number):
+        entry = session['sources'][source]
+        if 'page_size_cm' in entry:
+            return pdf_pages.Page.from_image(paths[source],
+                                             entry['page_size_cm'],
+                                             frame=entry['frame'], lazy=True)
+        document = documents.get(source)
+        if document is None:
+            document = documents[source] = pdf_sources.cache.open(
+                paths[source])
+        return pdf_pages.Page.from_source(document, page_number)
+
+    states = []
+    try:
+        for source, page_number, ops in session['states']:
+            page = new_page(source, page_number)
+            for op in ops:
+                if op[0] == 'rotate':
+                    if op[1] > 0:
+                        page.rotateRight()
+                    else:
+                        page.rotateLeft()
+                else:
+                    op, state, tx, ty = op
+                    page.merge(states[state], tx, ty, op)
+            states.append(page)
+    finally:
+        for document in documents.values():
+            document.release()
+    return [states[i] for i in session['pages']]
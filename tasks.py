@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Background tasks, so that long operations don't freeze the main window.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import traceback
+
+from qtpy import QtCore
+
+import profiling
+
+
+class Cancelled(Exception):
+    """Raised inside a task once it has been cancelled."""
+
+
+class TaskSignals(QtCore.QObject):
+    # QRunnable isn't a QObject, so it can't have signals itself
+    progress = QtCore.Signal(int, int)
+    result = QtCore.Signal(object)
+    error = QtCore.Signal(object, str)
+    finished = QtCore.Signal()
+
+
+class Task(QtCore.QRunnable):
+    """Runs `function(task, *args)` in a worker thread of the global
+    QThreadPool.
+
+    The function reports progress with `task.progress(done, total)` and
+    streams partial results with `task.result(obj)`, which are delivered as
+    signals in the main thread. Once `cancel()` has been called, `progress`
+    raises `Cancelled`, which stops the task at its next report. Results are
+    always delivered, since they describe work that was already done.
+    Exceptions are delivered by the `error` signal, with their traceback.
+    When cProfile capture is enabled, tasks are profiled (see profiling).
+    """
+    def __init__(self, function, *args):
+        super(Task, self).__init__()
+        # The window keeps a reference to the running task
+        self.setAutoDelete(False)
+        self.function = function
+        self.args = args
+        self.signals = TaskSignals()
+        self.cancelled = False
+
+    def run(self):
+        try:
+            with profiling.profiled():
+                self.function(self, *self.args)
+        except Cancelled:
+            pass
+        except Exception as e:
+            self.signals.error.emit(e, traceback.format_exc())
+        finally:
+            self.signals.finished.emit()
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    def progress(self, done, total):
+        self.check()
+        self.signals.progress.emit(done, total)
+
+    def result(self, obj):
+        self.signals.result.emit(obj)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def start(self, pool=None):
+        (pool or QtCore.QThreadPool.globalInstance()).start(self)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Incremental updates (pdf_pages.write_incremental) must save the same pages
+as a full rewrite.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import io
+
+import PyPDF2 as pdf
+import pytest
+
+import benchmark
+import page_index
+import pdf_images
+import pdf_pages
+import session
+import thumbnails
+
+
+def test_background_kept(tmp_path):
+    source = str(tmp_path / 'a.pdf')
+    background = str(tmp_path / 'b.pdf')
+    benchmark.synthetic_pdf(source, 3)
+    benchmark.synthetic_pdf(background, 1, images=['flate'], image_size=16)
+    pages = pdf_pages.Page.from_file(source)
+    pages[1].merge(pdf_pages.Page.from_file(background)[0], 0, 0,
+                   'background')
+
+    assert pdf_pages.write_incremental(pages, source)
+    reader = pdf.PdfFileReader(source, strict=False)
+    assert reader.getNumPages() == 3
+    assert [pdf_images.image_count(reader.getPage(i))
+            for i in range(3)] == [0, 1, 0]
+
+
+def write_pdf(filename, objects):
+    """Writes a PDF of `objects`, numbered from 1, the first being the
+    catalog.
+    """
+    offsets = []
+    with open(filename, 'wb') as f:
+        f.write(b"%PDF-1.4\n")
+        for idnum, obj in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write("{} 0 obj\n{}\nendobj\n".format(idnum, obj)
+                    .encode('ascii'))
+        xref = f.tell()
+        f.write("xref\n0 {}\n0000000000 65535 f \n".format(len(objects) + 1)
+                .encode('ascii'))
+        for offset in offsets:
+            f.write("{:010} 00000 n \n".format(offset).encode('ascii'))
+        f.write("trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n"
+                .format(len(objects) + 1, xref).encode('ascii'))
+
+
+def test_inherited_attributes_kept(tmp_path):
+    source = str(tmp_path / 'a.pdf')
+    write_pdf(source, [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R 4 0 R 5 0 R] /Count 3 "
+        "/MediaBox [0 0 300 500] /Rotate 90 /Resources << >> >>",
+        "<< /Type /Page /Parent 2 0 R >>",
+        "<< /Type /Page /Parent 2 0 R >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 100 100] >>",
+    ])
+    pages = pdf_pages.Page.from_file(source)
+    pages[1].rotateRight()
+    # Reordered, so the page tree is replaced; pages 0 and 2 are kept as
+    # they are in the file
+    assert pdf_pages.write_incremental([pages[2], pages[1], pages[0]],
+                                       source)
+    reader = pdf.PdfFileReader(source, strict=False)
+    assert [(float(page.mediaBox.getWidth()), float(page.mediaBox.getHeight()),
+             page['/Rotate'])
+            for page in reader.pages] == [(100, 100, 90), (300, 500, 180),
+                                          (300, 500, 90)]
+
+
+def test_session_of_updated_file_refused(tmp_path):
+    source = str(tmp_path / 'a.pdf')
+    benchmark.synthetic_pdf(source, 2)
+    pages = pdf_pages.Page.from_file(source)
+    pages[1].rotateRight()
+    assert pdf_pages.write_incremental([pages[1], pages[0]], source)
+    with pytest.raises(ValueError):
+        session.save_session(str(tmp_path / 'a.pypdftk'), pages)
+
+
+def test_updated_file_indexed_as_loaded(tmp_path):
+    source = str(tmp_path / 'a.pdf')
+    write_pdf(source, [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R 4 0 R] /Count 2 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 100 200] >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 300 200] >>",
+    ])
+    pages = pdf_pages.Page.from_file(source)
+    pages[0].rotateRight()
+    assert pdf_pages.write_incremental([pages[1], pages[0]], source)
+    index = page_index.PageIndex()
+    assert index.update(pages, processes=1) == []
+    assert [index.entry(page).rotation for page in pages] == [90, 0]
+    assert index.search(pages, 'landscape') == [0, 1]
+    # Thumbnails are rendered from the pages as loaded, not from the file
+    job = thumbnails.ThumbnailJob(pages[0])
+    assert job.transformed
+    page = pdf.PdfFileReader(io.BytesIO(job._data()), strict=False).getPage(0)
+    assert (float(page.mediaBox.getWidth()), page['/Rotate']) == (100, 90)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+The Python PDF Toolkit
+Copyright ©2016 Ronan Paixão
+Licensed under the terms of the MIT License.
+
+See LICENSE.txt for details.
+
+Page thumbnails, rendered with PyMuPDF (optional: without it, pages are
+shown without thumbnails) and kept in an on-disk cache.
+
+@author: Ronan Paixão
+"""
+
+from __future__ import division, unicode_literals, print_function
+
+import os
+import os.path as osp
+import hashlib
+from io import BytesIO
+
+try:
+    import pymupdf as fitz
+except ImportError:
+    try:
+        import fitz  # PyMuPDF < 1.24
+    except ImportError:
+        fitz = None
+
+import pdf_sources
+import pdf_writer
+
+
+def available():
+    return fitz is not None
+
+
+def _description(page):
+    """The page's source, page number (or frame, for multi-page images) and
+    operations, with the pages merged with it described the same way.
+    """
+    ops = tuple(op if op[0] == 'rotate' else
+                (op[0], _description(op[1]), float(op[2]), float(op[3]))
+                for op in page.ops)
+    return (page.source, page.page_number + page.source.frame, ops)
+
+
+def _key(description):
+    source, page_number, ops = description
+    return (source.digest, page_number,
+            tuple(op if op[0] == 'rotate' else (op[0], _key(op[1])) + op[2:]
+                  for op in ops))
+
+
+class ThumbnailJob(object):
+    """Everything needed to render a page's thumbnail, gathered in the thread
+    owning the page: a snapshot of the page, unaffected by its later
+    operations.
+
+    Pages only rotated since they were loaded are rendered straight from
+    their file, unless it changed since (see SourceDocument.changed). Other
+    pages (merged, stamped...) are written to a one page PDF, which is what
+    gets rendered, in the rendering thread, holding their documents' reader
+    locks.
+    """
+    def __init__(self, page):
+        self.page = page.snapshot()
+        self.sources = list(page.sources)
+        # The frame, for pages of multi-page images
+        self.page_number = page.page_number + page.source.frame
+        self.description = _description(page)
+        turns = page.transforms.count('↻') - page.transforms.count('↺')
+        self.rotation = turns * 90 % 360
+        self.transformed = (len(self.sources) != 1 or
+                            bool(page.transforms.strip('↻↺')) or
+                            self.sources[0].changed)
+
+    def key(self):
+        """Cache key: the source files' hashes, the page index and the
+        operations applied to the page, including where pages were stamped
+        or merged.
+        """
+        return _key(self.description)
+
+    def _data(self):
+        buf = BytesIO()
+        with pdf_sources.locked(self.sources):
+            writer = pdf_writer.StreamingPdfWriter(buf)
+            writer.add_page(self.page.rendered())
+            writer.close()
+        return buf.getvalue()
+
+    def render(self, size=72):
+        """Returns the thumbnail as PNG data, `size` pixels on its longest
+        side.
+        """
+        rotation = self.rotation
+        if self.transformed:
+            document = fitz.open(stream=self._data(), filetype='pdf')
+            page_number = 0
+            rotation = 0
+        else:
+            document = fitz.open(self.sources[0].origin)
+            page_number = self.page_number
+            if not document.is_pdf:  # Image file
+                # Only the page's frame, for multi-page images
+                data = document.convert_to_pdf(from_page=page_number,
+                                               to_page=page_number)
+                document.close()
+                document = fitz.open('pdf', data)
+                page_number = 0
+        try:
+            page = document[page_number]
+            if rotation:
+                page.set_rotation((page.rotation + rotation) % 360)
+            zoom = size / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom),
+                                     alpha=False)
+            return pixmap.tobytes('png')
+        finally:
+            document.close()
+
+
+class ThumbnailCache(object):
+    """Thumbnails stored as PNG files in `directory`, named after a hash of
+    their key.
+
+    Once the files add up to more than `max_bytes`, the least recently used
+    ones are removed. Files are touched when read, so their modification
+    time is their last use.
+    """
+    def __init__(self, directory, max_bytes=64 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._bytes = None  # Total size, scanned on first write
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return osp.join(self.directory, name + '.png')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        if not osp.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(key)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self._bytes is None:
+            self.trim()
+        else:
+            self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self.trim()
+
+    def trim(self):
+        """Removes the least recently used thumbnails until the cache is
+        within its budget.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.png'):
+                try:
+                    stat = os.stat(osp.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(osp.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+        self._bytes = total